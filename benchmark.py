@@ -0,0 +1,294 @@
+"""micro benchmarks for graph and input pipeline changes
+
+usage: python benchmark.py <case> [--param_set full] [--steps 20]
+e.g.   python benchmark.py cells --param_set medium --device_type cpu
+       python benchmark.py yellowfin --param_set tiny --steps 200
+"""
+import argparse
+import importlib
+from time import time
+
+import numpy as np
+import tensorflow as tf
+
+from helpers import print_out, generate_one_batch
+from model_helpers import session_config
+
+
+def load_params(param_set):
+    return importlib.import_module("params.%s" % param_set)
+
+
+def peak_bytes(run_metadata):
+    """largest allocator peak seen in a traced step"""
+    peak = 0
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        for node_stats in dev_stats.node_stats:
+            for memory in node_stats.memory:
+                peak = max(peak, memory.peak_bytes)
+    return peak
+
+
+def time_steps(sess, fetches, feed_dict, steps):
+    """(seconds per step, peak bytes of one traced step), after a warm-up step"""
+    sess.run(fetches, feed_dict=feed_dict)
+
+    run_metadata = tf.RunMetadata()
+    sess.run(fetches, feed_dict=feed_dict,
+             options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), run_metadata=run_metadata)
+
+    start = time()
+    for _ in range(steps):
+        sess.run(fetches, feed_dict=feed_dict)
+    return (time() - start) / steps, peak_bytes(run_metadata)
+
+
+"""bag-of-words loss"""
+def bow_case(FLAGS):
+    params = load_params(FLAGS.param_set)
+    batch_size = params.batch_size
+    hidden_dim = params.latent_dim + 2 * params.num_unit + params.emoji_dim
+    max_time = FLAGS.max_time
+
+    rep_len = np.random.randint(1, max_time, size=[batch_size]).astype(np.int32)
+    rep_output = np.random.randint(0, FLAGS.vocab_size, size=[max_time, batch_size]).astype(np.int32)
+    hidden = np.random.randn(batch_size, hidden_dim).astype(np.float32)
+
+    for tiled in (True, False):
+        with tf.Graph().as_default():
+            tf.set_random_seed(0)  # same projection in both graphs, so the losses must agree
+            hidden_t = tf.constant(hidden)
+            rep_output_t = tf.constant(rep_output)
+            target_mask_t = tf.transpose(tf.sequence_mask(rep_len, max_time, dtype=tf.float32))
+            latent_logits = tf.layers.dense(hidden_t, FLAGS.vocab_size, use_bias=False)
+
+            if tiled:
+                logits = tf.tile(tf.expand_dims(latent_logits, 0), [max_time, 1, 1])
+                cross_entropy = tf.nn.sparse_softmax_cross_entropy_with_logits(
+                    labels=rep_output_t, logits=logits)
+            else:
+                batch_index = tf.tile(tf.expand_dims(tf.range(batch_size), 0), [max_time, 1])
+                cross_entropy = -tf.gather_nd(
+                    tf.nn.log_softmax(latent_logits), tf.stack([batch_index, rep_output_t], axis=2))
+            bow_loss = tf.reduce_sum(cross_entropy * target_mask_t) / batch_size
+            gradients = tf.gradients(bow_loss, tf.trainable_variables())
+
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                loss = sess.run(bow_loss)
+                step_time, peak = time_steps(sess, [bow_loss, gradients], None, FLAGS.steps)
+        print_out("bow %s:\tloss %.4f\tstep %.1f ms\tpeak %.1f MB" % (
+            "tiled" if tiled else "gathered", loss, step_time * 1000, peak / 2. ** 20))
+
+
+def random_cvae_batch(batch_size, vocab_size, max_time):
+    """a CVAE batch of random tweets, word ids from 3 on (0-2 are reserved for tags)"""
+    def tweets():
+        return [np.random.randint(3, vocab_size, size=np.random.randint(3, max_time)) for _ in range(batch_size)]
+    emojis = np.random.randint(3, vocab_size, size=batch_size)
+    return generate_one_batch([emojis, tweets(), tweets()], 1, 2, 0, None)
+
+
+def time_cvae_train_step(params, FLAGS, batch, **kwargs):
+    """(seconds per training step, loss after the timed steps) of a CVAE built from params
+    trained on batch, kwargs override its keyword arguments"""
+    from cvae import CVAE
+
+    kwargs.setdefault("device_type", FLAGS.device_type or params.device_type)
+    kwargs.setdefault("cell_type", params.cell_type)
+    kwargs.setdefault("fused_encoder", params.fused_encoder)
+    with tf.Graph().as_default():
+        cvae = CVAE(FLAGS.vocab_size, params.embed_size, params.num_unit, params.latent_dim, params.emoji_dim,
+                    params.batch_size, 1., 1., params.decoder_layer, 1, 2, params.beam_width,
+                    params.maximum_iterations, params.max_gradient_norm, params.lr, params.dropout,
+                    params.num_gpu, num_sampled=params.num_sampled, **kwargs)
+        feed_dict = dict(zip(cvae.placeholders, batch))
+        feed_dict[cvae.kl_weight] = 1.
+
+        config = session_config(kwargs["device_type"], max(params.num_gpu, kwargs.get("num_tower", 1)))
+        with tf.Session(config=config) as sess:
+            sess.run(tf.global_variables_initializer())
+            step_time, _ = time_steps(sess, cvae.update_step, feed_dict, FLAGS.steps)
+            loss = sess.run(cvae.loss, feed_dict=feed_dict)
+    return step_time, loss
+
+
+"""data-parallel towers"""
+def towers_case(FLAGS):
+    params = load_params(FLAGS.param_set)
+    batch = random_cvae_batch(params.batch_size, FLAGS.vocab_size, FLAGS.max_time)
+
+    for num_tower in [int(n) for n in FLAGS.towers.split(",")]:
+        step_time, _ = time_cvae_train_step(params, FLAGS, batch, num_tower=num_tower)
+        print_out("%d tower(s):\tstep %.1f ms\t%.1f examples/sec" % (
+            num_tower, step_time * 1000, params.batch_size / step_time))
+
+
+"""fused rnn cells"""
+def cells_case(FLAGS):
+    params = load_params(FLAGS.param_set)
+    batch = random_cvae_batch(params.batch_size, FLAGS.vocab_size, FLAGS.max_time)
+
+    variants = [
+        ("GRUCell", dict(cell_type=tf.nn.rnn_cell.GRUCell)),
+        ("GRUBlockCellV2", dict(cell_type=tf.contrib.rnn.GRUBlockCellV2)),
+        ("GRUBlockCellV2, fused encoders", dict(cell_type=tf.contrib.rnn.GRUBlockCellV2, fused_encoder=True)),
+    ]
+    for name, kwargs in variants:
+        step_time, _ = time_cvae_train_step(params, FLAGS, batch, **kwargs)
+        print_out("%s (%s):\tstep %.1f ms" % (name, FLAGS.param_set, step_time * 1000))
+
+
+"""YellowFin cubic solver"""
+def np_roots_cubic_root(const_fact):
+    """the root that YFOptimizer.get_mu_tensor used to pick from tf.py_func(np.roots)"""
+    roots = np.roots(np.array([-1., 3., -(3. + const_fact), 1.], dtype=np.float32)).astype(np.complex64)
+    roots = roots[(roots.real > 0) & (roots.real < 1) & (np.abs(roots.imag) < 1e-5)]
+    return np.float32(roots[0].real)
+
+
+def time_yellowfin_step(FLAGS, solver):
+    """seconds per YFOptimizer step on a two-layer regression, with get_cubic_root replaced by solver"""
+    import yellowfin
+
+    inputs = np.random.randn(256, 512).astype(np.float32)
+    targets = np.random.randn(256, 1).astype(np.float32)
+    closed_form = yellowfin.get_cubic_root
+    yellowfin.get_cubic_root = solver
+    try:
+        with tf.Graph().as_default():
+            hidden = tf.layers.dense(tf.constant(inputs), 512, activation=tf.nn.relu)
+            loss = tf.reduce_mean(tf.square(tf.layers.dense(hidden, 1) - targets))
+            update_step = yellowfin.YFOptimizer(learning_rate=1., momentum=0.).minimize(loss)
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                step_time, _ = time_steps(sess, update_step, None, FLAGS.steps)
+    finally:
+        yellowfin.get_cubic_root = closed_form
+    return step_time
+
+
+def cubic_case(FLAGS):
+    from yellowfin import get_cubic_root
+
+    const_facts = np.logspace(-8, 8, 2001)
+    with tf.Graph().as_default():
+        const_fact = tf.placeholder(tf.float32, shape=[None])
+        with tf.Session() as sess:
+            roots = sess.run(get_cubic_root(const_fact), {const_fact: const_facts})
+    np_roots = np.array([np_roots_cubic_root(c) for c in const_facts])
+    print_out("closed form vs np.roots (float32) over const_fact 1e-8..1e8:\tmax |diff| %.2e" % (
+        np.max(np.abs(roots - np_roots))))
+    # float32 np.roots is itself inaccurate near the triple root 1 of small const_fact
+    large = const_facts > 1e-3
+    print_out("closed form vs np.roots (float32) over const_fact 1e-3..1e8:\tmax |diff| %.2e" % (
+        np.max(np.abs(roots[large] - np_roots[large]))))
+
+    def py_func_root(const_fact):
+        return tf.reshape(tf.py_func(np_roots_cubic_root, [const_fact], Tout=tf.float32, stateful=False), [])
+
+    for name, solver in [("closed form", get_cubic_root), ("py_func(np.roots)", py_func_root)]:
+        step_time = time_yellowfin_step(FLAGS, solver)
+        print_out("YFOptimizer step, %s:\t%.2f ms" % (name, step_time * 1000))
+
+
+"""YellowFin on sparse gradients"""
+def yellowfin_case(FLAGS):
+    from yellowfin import YFOptimizer
+
+    params = load_params(FLAGS.param_set)
+    ids = np.random.randint(0, FLAGS.vocab_size, size=[params.batch_size, FLAGS.max_time])
+    targets = np.random.randn(params.batch_size, 1).astype(np.float32)
+    with tf.Graph().as_default():
+        embedding = tf.get_variable("embedding", [FLAGS.vocab_size, params.embed_size])
+        # the gradient of the embedding is IndexedSlices of the looked up rows
+        hidden = tf.reduce_mean(tf.nn.embedding_lookup(embedding, ids), axis=1)
+        loss = tf.reduce_mean(tf.square(tf.layers.dense(hidden, 1) - targets))
+        optimizer = YFOptimizer(learning_rate=1., momentum=0.)
+        update_step = optimizer.minimize(loss)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            step_time, peak = time_steps(sess, update_step, None, FLAGS.steps)
+            lr, mu = sess.run([optimizer._lr_var, optimizer._mu_var])
+    print_out("YFOptimizer, [%d, %d] embedding:\tstep %.1f ms\tpeak %.1f MB\tlr %.4f\tmu %.4f" % (
+        FLAGS.vocab_size, params.embed_size, step_time * 1000, peak / 2. ** 20, lr, mu))
+
+    # amortized tuning: the CVAE trained on one batch, lr and momentum retuned every interval steps
+    batch = random_cvae_batch(params.batch_size, FLAGS.vocab_size, FLAGS.max_time)
+    for interval in [int(n) for n in FLAGS.yf_intervals.split(",")]:
+        step_time, loss = time_cvae_train_step(
+            params, FLAGS, batch, optimizer="yellowfin", mu_update_interval=interval)
+        print_out("CVAE (%s), YellowFin tuned every %d step(s):\tstep %.1f ms\tloss after %d steps %.3f" % (
+            FLAGS.param_set, interval, step_time * 1000, FLAGS.steps + 2, loss))
+
+
+"""sparse embedding updates"""
+def lazy_adam_case(FLAGS):
+    params = load_params(FLAGS.param_set)
+    for vocab_size in [int(n) for n in FLAGS.vocab_sizes.split(",")]:
+        FLAGS.vocab_size = vocab_size
+        batch = random_cvae_batch(params.batch_size, vocab_size, FLAGS.max_time)
+        for optimizer in ("adam", "lazy_adam"):
+            step_time, _ = time_cvae_train_step(params, FLAGS, batch, optimizer=optimizer)
+            print_out("vocab %d, %s:\tstep %.1f ms" % (vocab_size, optimizer, step_time * 1000))
+
+
+"""length-adaptive decode budget"""
+def decode_case(FLAGS):
+    from cvae import CVAE
+
+    params = load_params(FLAGS.param_set)
+    device_type = FLAGS.device_type or params.device_type
+    batches = [random_cvae_batch(params.batch_size, FLAGS.vocab_size, FLAGS.max_time) for _ in range(FLAGS.steps)]
+    for ratio in (0., FLAGS.decode_length_ratio):
+        with tf.Graph().as_default():
+            cvae = CVAE(FLAGS.vocab_size, params.embed_size, params.num_unit, params.latent_dim, params.emoji_dim,
+                        params.batch_size, 1., 1., params.decoder_layer, 1, 2, params.beam_width,
+                        params.maximum_iterations, params.max_gradient_norm, params.lr, params.dropout,
+                        params.num_gpu, params.cell_type, device_type=device_type,
+                        decode_length_ratio=ratio, infer_only=True)
+            with tf.Session(config=session_config(device_type, params.num_gpu)) as sess:
+                sess.run(tf.global_variables_initializer())
+                steps = 0
+                start = time()
+                for batch in batches:
+                    result = sess.run(cvae.result, feed_dict={
+                        cvae.emoji: batch[0], cvae.ori: batch[1], cvae.ori_len: batch[2]})
+                    steps += result.shape[0]
+                batch_time = (time() - start) / len(batches)
+        print_out("decode_length_ratio %.1f:\t%.1f decoder steps per batch\t%.1f ms per batch" % (
+            ratio, float(steps) / len(batches), batch_time * 1000))
+
+
+CASES = {
+    "bow": bow_case,
+    "towers": towers_case,
+    "cells": cells_case,
+    "cubic": cubic_case,
+    "yellowfin": yellowfin_case,
+    "lazy_adam": lazy_adam_case,
+    "decode": decode_case,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("case", choices=sorted(CASES))
+    parser.add_argument("--param_set", type=str, default="full", help="""\
+        tiny/medium/full""")
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--vocab_size", type=int, default=50000)
+    parser.add_argument("--max_time", type=int, default=40)
+    parser.add_argument("--device_type", type=str, default=None, help="""\
+        gpu/cpu, defaults to the one of the params""")
+    parser.add_argument("--towers", type=str, default="1,2,4", help="""\
+        tower counts compared by the towers case""")
+    parser.add_argument("--yf_intervals", type=str, default="1,10,50", help="""\
+        YellowFin tuning intervals compared by the yellowfin case""")
+    parser.add_argument("--vocab_sizes", type=str, default="10000,50000,200000", help="""\
+        vocabulary sizes compared by the lazy_adam case""")
+    parser.add_argument("--decode_length_ratio", type=float, default=1.5, help="""\
+        compared with a fixed maximum_iterations budget by the decode case""")
+    FLAGS, _ = parser.parse_known_args()
+
+    np.random.seed(0)
+    CASES[FLAGS.case](FLAGS)
@@ -9,6 +9,8 @@ evaluation metrics for machine translation. COLING 2004.
 import collections
 import math
 
+import numpy as np
+
 
 def _get_ngrams(segment, max_order):
     """Extracts all n-grams upto a given maximum order from an input segment.
@@ -67,6 +69,28 @@ def compute_bleu(reference_corpus, translation_corpus, max_order=4,
             if possible_matches > 0:
                 possible_matches_by_order[order - 1] += possible_matches
 
+    return bleu_from_stats(matches_by_order, possible_matches_by_order,
+                           translation_length, reference_length, max_order, smooth)
+
+
+def bleu_from_stats(matches_by_order, possible_matches_by_order,
+                    translation_length, reference_length, max_order=4,
+                    smooth=False):
+    """BLEU of a corpus from its sufficient statistics.
+
+    Args:
+      matches_by_order: clipped n-gram matches of each order, summed over the
+          corpus.
+      possible_matches_by_order: n-grams of each order in the translations.
+      translation_length: total translation length.
+      reference_length: total length of the shortest reference of each
+          translation.
+      max_order: Maximum n-gram order to use when computing BLEU score.
+      smooth: Whether or not to apply Lin et al. 2004 smoothing.
+
+    Returns:
+      The tuple of compute_bleu.
+    """
     precisions = [0] * max_order
     for i in range(0, max_order):
         if smooth:
@@ -97,3 +121,267 @@ def compute_bleu(reference_corpus, translation_corpus, max_order=4,
     bleu = geo_mean * bp
 
     return bleu, precisions, bp, ratio, translation_length, reference_length
+
+
+"""vectorized BLEU over integer token ids"""
+
+
+def _as_flat(segments):
+    """concatenated int32 tokens and int64 start offsets of segments"""
+    lengths = np.fromiter((len(s) for s in segments), dtype=np.int64, count=len(segments))
+    offsets = np.zeros(len(segments) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    tokens = np.fromiter((t for s in segments for t in s), dtype=np.int32, count=int(offsets[-1]))
+    return tokens, offsets
+
+
+def _ngram_ids(tokens, offsets, max_order):
+    """ids of the n-grams starting at each token, order by order.
+
+    Yields (starts, ids) for order 1 .. max_order: the positions in tokens
+    where an n-gram of the order fits in its segment and an int64 id per
+    n-gram, equal ids for equal n-grams. Ids of order n are dense ranks of
+    (id of order n - 1, next token), so they never overflow int64.
+    """
+    lengths = np.diff(offsets)
+    ends = np.repeat(offsets[1:], lengths)
+    starts = np.arange(len(tokens))
+    ids = tokens.astype(np.int64)
+    base = int(tokens.max()) + 1 if len(tokens) else 1
+    for order in range(1, max_order + 1):
+        if order > 1:
+            fits = starts + order <= ends[starts]
+            starts = starts[fits]
+            _, ids = np.unique(ids[fits] * base + tokens[starts + order - 1], return_inverse=True)
+            ids = ids.ravel().astype(np.int64)
+        yield starts, ids
+
+
+def compute_bleu_fast(reference_corpus, translation_corpus, max_order=4,
+                      smooth=False):
+    """compute_bleu for integer tokens, returns exactly the same tuple.
+
+    The n-grams of a whole corpus are counted with np.unique over int64
+    (sentence, n-gram id) keys instead of per-sentence Counters.
+    """
+    return bleu_from_stats(*bleu_stats(reference_corpus, translation_corpus, max_order),
+                           max_order=max_order, smooth=smooth)
+
+
+def bleu_stats(reference_corpus, translation_corpus, max_order=4):
+    """sufficient statistics of compute_bleu_fast: (matches_by_order,
+    possible_matches_by_order, translation_length, reference_length), they add
+    up over parts of a corpus."""
+    num_sentence = len(translation_corpus)
+    references = [r for references in reference_corpus for r in references]
+    num_reference = np.fromiter((len(r) for r in reference_corpus), dtype=np.int64, count=num_sentence)
+    # translations and references share one token array, so their n-gram ids agree
+    tokens, offsets = _as_flat(list(translation_corpus) + references)
+    lengths = np.diff(offsets)
+    translation_lengths, reference_lengths = lengths[:num_sentence], lengths[num_sentence:]
+    # segment i < num_sentence is translation i, the references of translation i follow the ones of i - 1
+    segments = np.repeat(np.arange(len(lengths)), lengths)
+    reference_owners = np.repeat(np.arange(num_sentence), num_reference)
+    num_translation_token = int(offsets[num_sentence])
+
+    shortest = np.minimum.reduceat(reference_lengths, np.cumsum(num_reference) - num_reference)
+    reference_length = int(shortest.sum())
+    translation_length = int(translation_lengths.sum())
+
+    matches_by_order = [0] * max_order
+    possible_matches_by_order = [0] * max_order
+    for order, (starts, ids) in enumerate(_ngram_ids(tokens, offsets, max_order), 1):
+        num_id = int(ids.max()) + 1 if len(ids) else 1
+        keys = segments[starts] * num_id + ids
+        in_translation = starts < num_translation_token
+        translation_keys, translation_counts = np.unique(keys[in_translation], return_counts=True)
+
+        # counts within each reference, then the maximum over the references of a sentence
+        keys, counts = np.unique(keys[~in_translation], return_counts=True)
+        keys = reference_owners[keys // num_id - num_sentence] * num_id + keys % num_id
+        reference_keys, inverse = np.unique(keys, return_inverse=True)
+        reference_counts = np.zeros(len(reference_keys), dtype=np.int64)
+        np.maximum.at(reference_counts, inverse.ravel(), counts)
+
+        _, translation_i, reference_i = np.intersect1d(
+            translation_keys, reference_keys, assume_unique=True, return_indices=True)
+        matches_by_order[order - 1] = int(
+            np.minimum(translation_counts[translation_i], reference_counts[reference_i]).sum())
+        possible_matches_by_order[order - 1] = int(np.maximum(translation_lengths - order + 1, 0).sum())
+
+    return matches_by_order, possible_matches_by_order, translation_length, reference_length
+
+
+class BleuAccumulator(object):
+    """corpus BLEU of batches added one at a time, keeps only the sufficient statistics"""
+    def __init__(self, max_order=4, smooth=False):
+        self.max_order = max_order
+        self.smooth = smooth
+        self.matches_by_order = [0] * max_order
+        self.possible_matches_by_order = [0] * max_order
+        self.translation_length = 0
+        self.reference_length = 0
+
+    def add(self, reference_corpus, translation_corpus):
+        self.add_stats(*bleu_stats(reference_corpus, translation_corpus, self.max_order))
+
+    def add_indexed(self, reference_index, translation_corpus, start):
+        """translation_corpus against the sentences start, start + 1, ... of a ReferenceIndex"""
+        assert reference_index.max_order == self.max_order
+        self.add_stats(*reference_index.stats(translation_corpus, start))
+
+    def add_stats(self, matches, possible_matches, translation_length, reference_length):
+        for i in range(self.max_order):
+            self.matches_by_order[i] += matches[i]
+            self.possible_matches_by_order[i] += possible_matches[i]
+        self.translation_length += translation_length
+        self.reference_length += reference_length
+
+    def result(self):
+        """the tuple of compute_bleu over everything added"""
+        return bleu_from_stats(self.matches_by_order, self.possible_matches_by_order,
+                               self.translation_length, self.reference_length, self.max_order, self.smooth)
+
+
+class ReferenceIndex(object):
+    """n-gram counts of a fixed reference corpus, extracted once.
+
+    For every order n, ngrams[n - 1] sorts the distinct reference n-grams as
+    (position of their first n - 1 tokens in ngrams[n - 2]) * base + last token,
+    so a hypothesis n-gram is looked up with one searchsorted per order and
+    never matches if its prefix did not. keys[n - 1] are the sorted
+    sentence * len(ngrams[n - 1]) + n-gram position of each sentence, counts[n - 1]
+    their clipping counts (the maximum over the references of the sentence),
+    shortest the length of the shortest reference of each sentence.
+    """
+    def __init__(self, ngrams, keys, counts, shortest, base):
+        self.ngrams = ngrams
+        self.keys = keys
+        self.counts = counts
+        self.shortest = shortest
+        self.base = base
+
+    @property
+    def max_order(self):
+        return len(self.ngrams)
+
+    def __len__(self):
+        return len(self.shortest)
+
+    @classmethod
+    def build(cls, reference_corpus, max_order=4):
+        """reference_corpus as for compute_bleu, of integer tokens"""
+        num_reference = np.fromiter((len(r) for r in reference_corpus), dtype=np.int64,
+                                    count=len(reference_corpus))
+        tokens, offsets = _as_flat([r for references in reference_corpus for r in references])
+        owners = np.repeat(np.arange(len(reference_corpus)), num_reference)
+        return cls.from_flat(tokens, offsets, owners, max_order)
+
+    @classmethod
+    def from_flat(cls, tokens, offsets, owners, max_order=4):
+        """references as concatenated tokens with start offsets (from 0), owners: the sentence of each
+        reference, the references of a sentence are adjacent"""
+        tokens = np.asarray(tokens, dtype=np.int64)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        owners = np.asarray(owners, dtype=np.int64)
+        lengths = np.diff(offsets)
+        first = np.flatnonzero(np.r_[True, owners[1:] != owners[:-1]])
+        shortest = np.minimum.reduceat(lengths, first).astype(np.int32)
+        base = int(tokens.max()) + 1 if len(tokens) else 1
+
+        ends = np.repeat(offsets[1:], lengths)
+        segments = np.repeat(np.arange(len(lengths)), lengths)
+        starts = np.arange(len(tokens))
+        ids = np.zeros(len(tokens), dtype=np.int64)
+        ngrams, keys, counts = [], [], []
+        for order in range(1, max_order + 1):
+            fits = starts + order <= ends[starts]
+            ids, starts = ids[fits], starts[fits]
+            order_ngrams, ids = np.unique(ids * base + tokens[starts + order - 1], return_inverse=True)
+            ids = ids.ravel().astype(np.int64)
+            num_id = max(len(order_ngrams), 1)
+            # counts within each reference, then the maximum over the references of a sentence
+            reference_keys, reference_counts = np.unique(segments[starts] * num_id + ids, return_counts=True)
+            order_keys, inverse = np.unique(
+                owners[reference_keys // num_id] * num_id + reference_keys % num_id, return_inverse=True)
+            order_counts = np.zeros(len(order_keys), dtype=np.int32)
+            np.maximum.at(order_counts, inverse.ravel(), reference_counts.astype(np.int32))
+            ngrams.append(order_ngrams)
+            keys.append(order_keys)
+            counts.append(order_counts)
+        return cls(ngrams, keys, counts, shortest, base)
+
+    def arrays(self):
+        """name -> array, for saving with np.save"""
+        arrays = {"shortest": self.shortest, "base": np.array(self.base, dtype=np.int64)}
+        for order in range(1, self.max_order + 1):
+            arrays["ngrams_%d" % order] = self.ngrams[order - 1]
+            arrays["keys_%d" % order] = self.keys[order - 1]
+            arrays["counts_%d" % order] = self.counts[order - 1]
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        max_order = sum(1 for name in arrays if name.startswith("ngrams_"))
+        return cls([arrays["ngrams_%d" % order] for order in range(1, max_order + 1)],
+                   [arrays["keys_%d" % order] for order in range(1, max_order + 1)],
+                   [arrays["counts_%d" % order] for order in range(1, max_order + 1)],
+                   arrays["shortest"], int(arrays["base"]))
+
+    def stats(self, translation_corpus, start=0):
+        """bleu_stats of translation_corpus against the references of sentences start, start + 1, ...,
+        only the n-grams of the translations are extracted"""
+        assert start + len(translation_corpus) <= len(self), "more translations than references"
+        tokens, offsets = _as_flat(translation_corpus)
+        tokens = tokens.astype(np.int64)
+        lengths = np.diff(offsets)
+        ends = np.repeat(offsets[1:], lengths)
+        sentences = np.repeat(np.arange(start, start + len(lengths)), lengths)
+        reference_length = int(self.shortest[start:start + len(lengths)].sum())
+        translation_length = int(lengths.sum())
+
+        matches_by_order = [0] * self.max_order
+        possible_matches_by_order = [0] * self.max_order
+        starts = np.arange(len(tokens))
+        ids = np.zeros(len(tokens), dtype=np.int64)
+        for order in range(1, self.max_order + 1):
+            possible_matches_by_order[order - 1] = int(np.maximum(lengths - order + 1, 0).sum())
+            # n-grams whose prefix is no reference n-gram are dropped, they cannot match
+            last = starts + order - 1
+            fits = (last < ends[starts]) & (ids >= 0)
+            ids, starts, last = ids[fits], starts[fits], last[fits]
+            in_vocab = tokens[last] < self.base
+            ids, starts, last = ids[in_vocab], starts[in_vocab], last[in_vocab]
+            order_ngrams = self.ngrams[order - 1]
+            values = ids * self.base + tokens[last]
+            positions = np.minimum(np.searchsorted(order_ngrams, values), max(len(order_ngrams) - 1, 0))
+            found = order_ngrams[positions] == values if len(order_ngrams) else np.zeros(len(values), bool)
+            ids = np.where(found, positions, -1)
+
+            num_id = max(len(order_ngrams), 1)
+            translation_keys, translation_counts = np.unique(
+                sentences[starts[found]] * num_id + ids[found], return_counts=True)
+            _, translation_i, reference_i = np.intersect1d(
+                translation_keys, self.keys[order - 1], assume_unique=True, return_indices=True)
+            matches_by_order[order - 1] = int(
+                np.minimum(translation_counts[translation_i], self.counts[order - 1][reference_i]).sum())
+        return matches_by_order, possible_matches_by_order, translation_length, reference_length
+
+
+if __name__ == '__main__':
+    # timings, the equivalence checks are in tests/test_bleu.py
+    from time import time
+
+    rng = np.random.RandomState(0)
+    translations = [list(rng.randint(20000, size=rng.randint(1, 30))) for _ in range(20000)]
+    references = [[list(rng.randint(20000, size=rng.randint(1, 30)))] for _ in range(20000)]
+    for bleu in (compute_bleu, compute_bleu_fast):
+        start = time()
+        bleu(references, translations)
+        print("%s:\t%.2f s for 20000 sentences" % (bleu.__name__, time() - start))
+    start = time()
+    index = ReferenceIndex.build(references)
+    print("ReferenceIndex.build:\t%.2f s" % (time() - start))
+    start = time()
+    bleu_from_stats(*index.stats(translations))
+    print("ReferenceIndex.stats:\t%.2f s" % (time() - start))
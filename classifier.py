@@ -3,6 +3,7 @@ import numpy as np
 
 from emoji_reader import emoji_64
 from model_helpers import Embedding, xavier, build_bidirectional_rnn
+from model_helpers import tower_devices, split_batch, sum_gradients, create_optimizer
 
 class EmojiClassifier(object):
     def __init__(self,
@@ -14,40 +15,76 @@ class EmojiClassifier(object):
                  num_gpu,
                  lr=0.001,
                  dropout=0.,
-                 cell_type=tf.nn.rnn_cell.GRUCell
+                 cell_type=tf.nn.rnn_cell.GRUCell,
+                 device_type="gpu",
+                 num_tower=1,
+                 optimizer="adam"
                  ):
+        self.emoji_num = emoji_num
+        self.num_unit = num_unit
         self.dropout = dropout
         self.num_gpu = num_gpu
         self.cell_type = cell_type
 
-        self.text = tf.placeholder(tf.int32, shape=[None, batch_size], name="text")
-        self.len = tf.placeholder(tf.int32, shape=[batch_size], name="text_length")
-        self.emoji = tf.placeholder(tf.int32, shape=[batch_size], name="emoji_label")
+        # batch_size is only nominal, any batch size can be fed
+        self.text = tf.placeholder(tf.int32, shape=[None, None], name="text")
+        self.len = tf.placeholder(tf.int32, shape=[None], name="text_length")
+        self.emoji = tf.placeholder(tf.int32, shape=[None], name="emoji_label")
 
         with tf.variable_scope("embeddings"):
-            embedding = Embedding(vocab_size, embed_size)
-            text_emb = embedding(self.text)
+            self.embedding = Embedding(vocab_size, embed_size)
+
+        float_batch_size = tf.cast(tf.shape(self.emoji)[0], tf.float32)
+        # lazy_adam only updates the embedding rows a batch uses, see create_optimizer
+        optimizer = create_optimizer(optimizer, lr)
+        if num_tower == 1:
+            self._build_tower(self.text, self.len, self.emoji, float_batch_size, num_gpu, device_type)
+            with tf.variable_scope("optimization"):
+                self.update_step = optimizer.minimize(self.loss)
+        else:
+            towers = []
+            tower_grads = []
+            tower_inputs = split_batch([self.text, self.len, self.emoji], [1, 0, 0], num_tower)
+            for i, device in enumerate(tower_devices(device_type, num_tower)):
+                with tf.device(device), tf.name_scope("tower_%d" % i), \
+                        tf.variable_scope(tf.get_variable_scope(), reuse=i > 0):
+                    text, length, emoji = tower_inputs[i]
+                    self._build_tower(text[:tf.reduce_max(length)], length, emoji, float_batch_size, 0, device_type)
+                    towers.append((self.loss, self.accuracy, self.top_5_accuracy))
+                    if i == 0:
+                        params = tf.trainable_variables()
+                    tower_grads.append(tf.gradients(self.loss, params, colocate_gradients_with_ops=True))
+
+            # tower values are normalized by the whole batch size
+            self.loss, self.accuracy, self.top_5_accuracy = [tf.add_n(values) for values in zip(*towers)]
+            with tf.variable_scope("optimization"):
+                self.update_step = optimizer.apply_gradients(zip(sum_gradients(tower_grads), params))
+
+    def _build_tower(self, text, length, emoji, float_batch_size, num_gpu, device_type):
+        with tf.variable_scope("embeddings"):
+            text_emb = self.embedding(text)
 
         with tf.variable_scope("bi_rnn_1"):  # difference between var scope and name scope?
             # tuple#2: [max_time, batch_size, num_unit]
             outputs_1, _ = build_bidirectional_rnn(
-                num_unit, text_emb, self.len, cell_type, num_gpu, drop=dropout)
+                self.num_unit, text_emb, length, self.cell_type, num_gpu, drop=self.dropout, device_type=device_type)
 
         with tf.variable_scope("bi_rnn_2"):
             rnn2_input = tf.concat([outputs_1[0], outputs_1[1]], axis=2)
             outputs_2, _ = build_bidirectional_rnn(
-                num_unit, rnn2_input, self.len, cell_type, num_gpu, drop=dropout)
+                self.num_unit, rnn2_input, length, self.cell_type, num_gpu, drop=self.dropout,
+                device_type=device_type)
 
         with tf.variable_scope("attention"):
             word_states = tf.concat(
                 [outputs_1[0], outputs_1[1], outputs_2[0], outputs_2[1], text_emb], axis=2)  # [max_t, b_sz, h_dim]
 
-            weights = tf.layers.dense(word_states, 1, kernel_initializer=xavier)
+            weights = tf.layers.dense(word_states, 1, kernel_initializer=xavier, name="dense")
             weights = tf.exp(weights)   # [max_len, batch_size, 1]
 
             # mask superfluous dimensions
-            max_time = tf.shape(self.text)[0]
-            weight_mask = tf.sequence_mask(self.len, max_time, dtype=tf.float32)
+            max_time = tf.shape(text)[0]
+            weight_mask = tf.sequence_mask(length, max_time, dtype=tf.float32)
             weight_mask = tf.expand_dims(
                 tf.transpose(weight_mask), axis=-1)  # transpose for time_major & expand to be broadcast-able
             weights = weights * weight_mask
@@ -61,20 +98,16 @@ class EmojiClassifier(object):
             text_vec = tf.squeeze(tf.matmul(word_states, weights), axis=2)  # [batch_size, h_dim]
 
         with tf.variable_scope("loss"):
-            logits = tf.layers.dense(text_vec, emoji_num, kernel_initializer=xavier)
-            self.loss = tf.reduce_mean(
-                tf.nn.sparse_softmax_cross_entropy_with_logits(labels=self.emoji, logits=logits))
+            logits = tf.layers.dense(text_vec, self.emoji_num, kernel_initializer=xavier, name="dense")
+            self.loss = tf.reduce_sum(
+                tf.nn.sparse_softmax_cross_entropy_with_logits(labels=emoji, logits=logits)) / float_batch_size
 
         with tf.variable_scope("accuracy"):
-            top_5_accuracy = tf.nn.in_top_k(logits, self.emoji, k=5)
-            self.top_5_accuracy = tf.reduce_mean(tf.cast(top_5_accuracy, tf.float32))
-
-            accuracy = tf.nn.in_top_k(logits, self.emoji, k=1)
-            self.accuracy = tf.reduce_mean(tf.cast(accuracy, tf.float32))
+            top_5_accuracy = tf.nn.in_top_k(logits, emoji, k=5)
+            self.top_5_accuracy = tf.reduce_sum(tf.cast(top_5_accuracy, tf.float32)) / float_batch_size
 
-        with tf.variable_scope("optimization"):
-            optimizer = tf.train.AdamOptimizer(lr)
-            self.update_step = optimizer.minimize(self.loss)
+            accuracy = tf.nn.in_top_k(logits, emoji, k=1)
+            self.accuracy = tf.reduce_sum(tf.cast(accuracy, tf.float32)) / float_batch_size
 
     def train_update(self, batch, sess):
         sess = sess or sess.get_default_session()
@@ -92,6 +125,7 @@ class EmojiClassifier(object):
         loss_l = []
         accuracy_l = []
         accuracy5_l = []
+        batch_size_l = []
 
         for batch in batches:
             text = batch[3]
@@ -105,7 +139,11 @@ class EmojiClassifier(object):
             loss_l.append(loss)
             accuracy_l.append(accuracy)
             accuracy5_l.append(accuracy5)
-        return float(np.mean(loss_l)), float(np.mean(accuracy_l)), float(np.mean(accuracy5_l))
+            batch_size_l.append(len(length))
+        # the last batch may be smaller
+        return (float(np.average(loss_l, weights=batch_size_l)),
+                float(np.average(accuracy_l, weights=batch_size_l)),
+                float(np.average(accuracy5_l, weights=batch_size_l)))
 
 
 batch_size = 128
@@ -114,6 +152,11 @@ emoji_num = 64
 embed_size = 200
 num_unit = 400
 num_gpu = 2
+device_type = "gpu"
+intra_op_threads = 0
+inter_op_threads = 0
+num_tower = 1
+optimizer = "adam"  # or lazy_adam, see create_optimizer
 
 
 def map_emoji(word_indices, emoji_index_dict):
@@ -128,10 +171,18 @@ if __name__ == '__main__':
     import json
 
     from helpers import build_vocab, build_data, build_emoji_index, batch_generator
-    from helpers import print_out
+    from helpers import print_out, prefetch
+    from model_helpers import add_profile_arguments, resolve_profile, session_config
+
+    classifier_parser = argparse.ArgumentParser()
+    add_profile_arguments(classifier_parser)
+    FLAGS, _ = classifier_parser.parse_known_args()
+    device_type, num_gpu, intra_op_threads, inter_op_threads = resolve_profile(
+        FLAGS, device_type, num_gpu, intra_op_threads, inter_op_threads)
 
     num_epoch = 3
     test_step = 50
+    prefetch_size = 8
 
     chdir("../data/full_64_input")
     output_dir = join("classify", strftime("%m-%d_%H-%M-%S", gmtime()))
@@ -153,19 +204,21 @@ if __name__ == '__main__':
 
     # building graph
     # embedding of discriminator's classifier should be in another graph
-    classifier = EmojiClassifier(batch_size, vocab_size, emoji_num, embed_size, num_unit, num_gpu)
+    classifier = EmojiClassifier(batch_size, vocab_size, emoji_num, embed_size, num_unit, num_gpu,
+                                 device_type=device_type, num_tower=num_tower, optimizer=optimizer)
 
     # building data
     train_data = build_data(train_ori_f, train_rep_f, word2index)
 
     test_data = build_data(test_ori_f, test_rep_f, word2index)
     test_batches = batch_generator(
-        test_data, start_i, end_i, batch_size, permutate=False)
+        test_data, start_i, end_i, batch_size, permutate=False, min_batch_size=num_tower)
 
     print_out("*** CLASSIFIER DATA READY ***")
 
     saver = tf.train.Saver()
-    with tf.Session() as sess:
+    num_device = max(num_gpu, num_tower)
+    with tf.Session(config=session_config(device_type, num_device, intra_op_threads, inter_op_threads)) as sess:
         best_f = join(output_dir, "best_accuracy.txt")
 
         global_step = best_step = 1
@@ -175,12 +228,12 @@ if __name__ == '__main__':
         # saver.restore(sess, "classify/08-09_21-30-45/breakpoints/best_test_loss.ckpt")
         for epoch in range(start_epoch, num_epoch + 1):
             train_batches = batch_generator(
-                train_data, start_i, end_i, batch_size)
+                train_data, start_i, end_i, batch_size, lazy=True, min_batch_size=num_tower)
 
             loss_l = []
             accuracy_l = []
             accuracy5_l = []
-            for batch in train_batches:
+            for batch in prefetch(train_batches, prefetch_size):
                 loss, accuracy, accuracy5 = classifier.train_update(batch, sess)
                 loss_l.append(loss)
                 accuracy_l.append(accuracy)
@@ -217,7 +270,7 @@ if __name__ == '__main__':
                             f.write(json.dumps(best_dict, indent=2))
                 global_step += 1
 
-            loss, accuracy, accuracy5 = classifier.eval(train_batches, sess)
+            loss, accuracy, accuracy5 = classifier.eval(prefetch(train_batches, prefetch_size), sess)
             print_out('EPOCH!\t%d\tTRAIN!\t%d\tTRAIN-loss/accuracy/accuracy5-\t%.3f\t%.1f\t%.1f' %
                       (epoch, global_step,
                        np.mean(loss_l), np.mean(accuracy_l) * 100, np.mean(accuracy5_l) * 100),
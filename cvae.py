@@ -1,11 +1,12 @@
 import tensorflow as tf
 import numpy as np
 
-from helpers import safe_exp
-from bleu import compute_bleu
+from helpers import safe_exp, split_micro_batches, truncate_generations
+from bleu import BleuAccumulator
 from tensorflow.python.layers import core as layers_core
-from model_helpers import Embedding, build_bidirectional_rnn, create_rnn_cell
-from yellowfin import YFOptimizer
+from model_helpers import Embedding, OutputProjection, build_bidirectional_rnn, create_rnn_cell
+from model_helpers import tower_devices, split_batch, sum_gradients, concat_tower_results
+from model_helpers import load_frozen_graph, create_optimizer, LengthLimitedGreedyHelper
 
 import tensorflow.contrib.seq2seq as seq2seq
 
@@ -29,22 +30,62 @@ class CVAE(object):
                  dropout=0.2,
                  num_gpu=2,
                  cell_type=tf.nn.rnn_cell.GRUCell,
-                 is_seq2seq=False):
+                 is_seq2seq=False,
+                 num_sampled=0,
+                 device_type="gpu",
+                 num_tower=1,
+                 fused_encoder=False,
+                 accum_steps=1,
+                 optimizer="adam",
+                 mu_update_interval=1,
+                 decode_length_ratio=0.,
+                 infer_only=False):
+        # num_sampled > 0: train the reconstruction loss with a sampled softmax over that many candidates,
+        # recon_loss (eval, perplexity) stays the full softmax
+        # num_tower > 1: split every batch over that many replicas on devices 0..num_tower-1 of device_type
+        # fused_encoder: the tweet encoders are fused LSTM kernels instead of cell_type (decoder keeps cell_type)
+        # accum_steps > 1: train_update splits a batch into that many micro-batches and updates once for all
+        # optimizer: adam, lazy_adam (sparse updates of the embedding rows a batch uses, accum_steps = 1 only)
+        # or yellowfin (tunes lr and momentum itself from lr on, every mu_update_interval steps), see create_optimizer
+        # decode_length_ratio > 0: generate at most ceil(ratio * len(original tweet)) words (and at most
+        # maximum_iterations), decoding stops once every tweet of the batch has ended or reached its budget.
+        # Greedy decoding only: beams would be ranked on steps past the budget
+        # infer_only: only what generation needs (no response encoder, training decoder, losses or optimizer),
+        # restores from a training checkpoint and can be frozen with model_helpers.freeze_graph
+        if optimizer == "lazy_adam" and accum_steps > 1:
+            raise ValueError("lazy_adam needs accum_steps = 1, the accumulation buffers make the gradients dense")
+        if decode_length_ratio > 0 and beam_width > 0:
+            raise ValueError("decode_length_ratio applies to greedy decoding only, beam_width must be 0")
+        self.vocab_size = vocab_size
+        self.start_i = start_i
         self.end_i = end_i
         self.batch_size = batch_size
         self.num_gpu = num_gpu
         self.num_unit = num_unit
+        self.latent_dim = latent_dim
+        self.emoji_dim = emoji_dim
+        self.decoder_layer = decoder_layer
+        self.kl_ceiling = kl_ceiling
+        self.bow_ceiling = bow_ceiling
+        self.maximum_iterations = maximum_iterations
+        self.decode_length_ratio = decode_length_ratio
         self.dropout = dropout
         self.beam_width = beam_width
         self.cell_type = cell_type
-
-        self.emoji = tf.placeholder(tf.int32, shape=[batch_size], name="emoji")
-        self.ori = tf.placeholder(tf.int32, shape=[None, batch_size], name="original_tweet")  # [len, batch_size]
-        self.ori_len = tf.placeholder(tf.int32, shape=[batch_size], name="original_tweet_length")
-        self.rep = tf.placeholder(tf.int32, shape=[None, batch_size], name="response_tweet")
-        self.rep_len = tf.placeholder(tf.int32, shape=[batch_size], name="response_tweet_length")
-        self.rep_input = tf.placeholder(tf.int32, shape=[None, batch_size], name="response_start_tag")
-        self.rep_output = tf.placeholder(tf.int32, shape=[None, batch_size], name="response_end_tag")
+        self.is_seq2seq = is_seq2seq
+        self.num_sampled = num_sampled
+        self.device_type = device_type
+        self.fused_encoder = fused_encoder
+        self.accum_steps = accum_steps
+
+        # batch_size is only nominal: the graph takes any batch size, e.g. the last partial batch
+        self.emoji = tf.placeholder(tf.int32, shape=[None], name="emoji")
+        self.ori = tf.placeholder(tf.int32, shape=[None, None], name="original_tweet")  # [len, batch_size]
+        self.ori_len = tf.placeholder(tf.int32, shape=[None], name="original_tweet_length")
+        self.rep = tf.placeholder(tf.int32, shape=[None, None], name="response_tweet")
+        self.rep_len = tf.placeholder(tf.int32, shape=[None], name="response_tweet_length")
+        self.rep_input = tf.placeholder(tf.int32, shape=[None, None], name="response_start_tag")
+        self.rep_output = tf.placeholder(tf.int32, shape=[None, None], name="response_end_tag")
 
         self.kl_weight = tf.placeholder(tf.float32, shape=(), name="kl_weight")
         # self.inferring = tf.placeholder_with_default(False, shape=(), name='inferring')
@@ -56,26 +97,112 @@ class CVAE(object):
         ]
 
         with tf.variable_scope("embeddings"):
-            embedding = Embedding(vocab_size, embed_size)
+            self.embedding = Embedding(vocab_size, embed_size)
+        # shared by the towers, their variables are created on the first call
+        self.projection_layer = OutputProjection(vocab_size, name="output_projection")
+        self.mlp_b = layers_core.Dense(vocab_size, use_bias=False, name="MLP_b")
+
+        if infer_only:
+            self._build_inference(self.emoji, self.ori, self.ori_len, num_gpu)
+            return
+
+        # losses are sums over the examples divided by this, fed with the whole batch size for micro-batches
+        self.loss_batch_size = tf.placeholder_with_default(
+            tf.cast(tf.shape(self.emoji)[0], tf.float32), shape=(), name="loss_batch_size")
+        float_batch_size = self.loss_batch_size
+        if num_tower == 1:
+            self._build_tower(self.placeholders, float_batch_size, num_gpu)
+        else:
+            # one replica per device on an even split of the batch, the cells stay on their tower's device
+            tower_inputs = split_batch(self.placeholders, [0, 1, 0, 1, 0, 1, 1], num_tower)
+            towers = []
+            tower_grads = []
+            for i, device in enumerate(tower_devices(device_type, num_tower)):
+                with tf.device(device), tf.name_scope("tower_%d" % i), \
+                        tf.variable_scope(tf.get_variable_scope(), reuse=i > 0):
+                    emoji, ori, ori_len, rep, rep_len, rep_input, rep_output = tower_inputs[i]
+                    # drop the padding rows of the longer tweets in other towers
+                    ori = ori[:tf.reduce_max(ori_len)]
+                    rep = rep[:tf.reduce_max(rep_len)]
+                    rep_input = rep_input[:tf.reduce_max(rep_len) + 1]
+                    rep_output = rep_output[:tf.reduce_max(rep_len) + 1]
+
+                    self._build_tower(
+                        [emoji, ori, ori_len, rep, rep_len, rep_input, rep_output], float_batch_size, 0)
+                    towers.append(dict(
+                        (name, getattr(self, name))
+                        for name in ("result", "recon_loss", "train_recon_loss", "kl_loss", "bow_loss", "loss",
+                                     "mu", "log_var", "p_mu", "p_log_var", "z_sample", "q_z_sample")))
+                    if i == 0:
+                        params = tf.trainable_variables()
+                    tower_grads.append(tf.gradients(self.loss, params, colocate_gradients_with_ops=True))
+
+            # every tower loss is normalized by the whole batch size: the batch values are the sums
+            for name in ("recon_loss", "train_recon_loss", "kl_loss", "bow_loss", "loss"):
+                setattr(self, name, tf.add_n([tower[name] for tower in towers]))
+            self.result = concat_tower_results([tower["result"] for tower in towers], end_i)
+            # the latent tensors are batch-major, the towers' parts concatenate back to the whole batch
+            for name in ("mu", "log_var", "p_mu", "p_log_var", "z_sample", "q_z_sample"):
+                setattr(self, name, tf.concat([tower[name] for tower in towers], axis=0))
+            # the towers' logits differ in length along time, none of them covers the whole batch
+            self.logits = None
 
-            ori_emb = embedding(self.ori)  # [max_len, batch_size, embedding_size]
-            rep_emb = embedding(self.rep)
-            rep_input_emb = embedding(self.rep_input)
-            emoji_emb = embedding(self.emoji)  # [batch_size, embedding_size]
+        # Calculate and clip gradients
+        with tf.variable_scope("optimization"):
+            if num_tower == 1:
+                params = tf.trainable_variables()
+                gradients = tf.gradients(self.loss, params)
+            else:
+                gradients = sum_gradients(tower_grads)
+
+            if accum_steps > 1:
+                # micro-batch gradients add up in local (not checkpointed) buffers,
+                # the update step clips and applies their sum and clears them
+                buffers = [tf.Variable(tf.zeros(param.shape, param.dtype), trainable=False, name="accum",
+                                       collections=[tf.GraphKeys.LOCAL_VARIABLES])
+                           for param in params]
+                self.accumulate_step = tf.group(*[
+                    tf.scatter_add(buffer, grad.indices, grad.values) if isinstance(grad, tf.IndexedSlices)
+                    else tf.assign_add(buffer, grad)
+                    for buffer, grad in zip(buffers, gradients) if grad is not None])
+                gradients = [buffer.read_value() for buffer in buffers]
+
+            # the IndexedSlices of the embedding stay sparse through clipping
+            clipped_gradients, _ = tf.clip_by_global_norm(
+                gradients, max_gradient_norm)
 
-        with tf.variable_scope("original_tweet_encoder"):
-            ori_encoder_output, ori_encoder_state = build_bidirectional_rnn(
-                num_unit, ori_emb, self.ori_len, cell_type, num_gpu)
-            ori_encoder_state_flat = tf.concat(
-                [ori_encoder_state[0], ori_encoder_state[1]], axis=1)
+            # Optimization
+            optimizer = create_optimizer(optimizer, lr, mu_update_interval)
+            self.update_step = optimizer.apply_gradients(
+                zip(clipped_gradients, params))
 
-        emoji_vec = tf.layers.dense(emoji_emb, emoji_dim, activation=tf.nn.tanh)
-        # emoji_vec = tf.ones([batch_size, emoji_dim], tf.float32)
-        condition_flat = tf.concat([ori_encoder_state_flat, emoji_vec], axis=1)
+            if accum_steps > 1:
+                with tf.control_dependencies([self.update_step]):
+                    self.update_step = tf.group(*[buffer.assign(tf.zeros_like(buffer)) for buffer in buffers])
+
+    def _build_tower(self, inputs, float_batch_size, num_gpu):
+        """encoders, decoders and losses of one replica, the outputs are set as attributes
+
+        Losses are normalized by float_batch_size, the size of the whole batch.
+        """
+        emoji, ori, ori_len, rep, rep_len, rep_input, rep_output = inputs
+        dynamic_batch_size = tf.shape(emoji)[0]
+
+        with tf.variable_scope("embeddings"):
+            embedding = self.embedding
+
+            ori_emb = embedding(ori)  # [max_len, batch_size, embedding_size]
+            rep_emb = embedding(rep)
+            rep_input_emb = embedding(rep_input)
+            emoji_emb = embedding(emoji)  # [batch_size, embedding_size]
+
+        ori_encoder_output, ori_encoder_state, ori_encoder_state_flat, emoji_vec, condition_flat = \
+            self._encode_condition(ori_emb, ori_len, emoji_emb, num_gpu)
 
         with tf.variable_scope("response_tweet_encoder"):
             _, rep_encoder_state = build_bidirectional_rnn(
-                num_unit, rep_emb, self.rep_len, cell_type, num_gpu)
+                self.num_unit, rep_emb, rep_len, self.cell_type, num_gpu, device_type=self.device_type,
+                fused=self.fused_encoder)
             rep_encoder_state_flat = tf.concat(
                 [rep_encoder_state[0], rep_encoder_state[1]], axis=1)
 
@@ -84,147 +211,91 @@ class CVAE(object):
             # simpler representation network
             # r_hidden = rn_input
             r_hidden = tf.layers.dense(
-                rn_input, latent_dim, activation=tf.nn.relu, name="r_net_hidden")  # int(1.6 * latent_dim)
+                rn_input, self.latent_dim, activation=tf.nn.relu, name="r_net_hidden")  # int(1.6 * latent_dim)
             r_hidden_mu = tf.layers.dense(
-                r_hidden, latent_dim, activation=tf.nn.relu)  # int(1.3 * latent_dim)
+                r_hidden, self.latent_dim, activation=tf.nn.relu, name="dense")  # int(1.3 * latent_dim)
             r_hidden_var = tf.layers.dense(
-                r_hidden, latent_dim, activation=tf.nn.relu)
+                r_hidden, self.latent_dim, activation=tf.nn.relu, name="dense_1")
             self.mu = tf.layers.dense(
-                r_hidden_mu, latent_dim, activation=tf.nn.tanh, name="q_mean")
+                r_hidden_mu, self.latent_dim, activation=tf.nn.tanh, name="q_mean")
             self.log_var = tf.layers.dense(
-                r_hidden_var, latent_dim, activation=tf.nn.tanh, name="q_log_var")
+                r_hidden_var, self.latent_dim, activation=tf.nn.tanh, name="q_log_var")
 
-        with tf.variable_scope("prior_network"):
-            # simpler prior network
-            # p_hidden = condition_flat
-            p_hidden = tf.layers.dense(
-                condition_flat, int(0.62 * latent_dim), activation=tf.nn.relu, name="r_net_hidden")
-            p_hidden_mu = tf.layers.dense(
-                p_hidden, int(0.77 * latent_dim), activation=tf.nn.relu)
-            p_hidden_var = tf.layers.dense(
-                p_hidden, int(0.77 * latent_dim), activation=tf.nn.relu)
-            self.p_mu = tf.layers.dense(
-                p_hidden_mu, latent_dim, activation=tf.nn.tanh, name="p_mean")
-            self.p_log_var = tf.layers.dense(
-                p_hidden_var, latent_dim, activation=tf.nn.tanh, name="p_log_var")
+        self._prior_network(condition_flat)
 
         with tf.variable_scope("reparameterization"):
             self.z_sample = self.mu + tf.exp(self.log_var / 2.) * tf.random_normal(shape=tf.shape(self.mu))
             self.q_z_sample = self.p_mu + tf.exp(self.p_log_var / 2.) * tf.random_normal(shape=tf.shape(self.p_mu))
 
-        if is_seq2seq:  # vanilla seq2seq
+        if self.is_seq2seq:  # vanilla seq2seq
             self.z_sample = self.z_sample - self.z_sample
             self.q_z_sample = self.q_z_sample - self.q_z_sample
 
-        with tf.variable_scope("attention"):
-            attention_state = tf.concat([ori_encoder_output[0], ori_encoder_output[1]], axis=2)
-            attention_state = tf.transpose(attention_state, [1, 0, 2])
-
-            attention_mechanism = seq2seq.BahdanauAttention(
-                num_unit, attention_state, memory_sequence_length=self.ori_len)
+        attention_mechanism = self._attention_mechanism(ori_encoder_output, ori_len)
 
         with tf.variable_scope("decoder_train") as decoder_scope:
-            if decoder_layer == 2:
-                train_decoder_init_state = (
-                    tf.concat([self.z_sample, ori_encoder_state[0], emoji_vec], axis=1),
-                    tf.concat([self.z_sample, ori_encoder_state[1], emoji_vec], axis=1)
-                )
-                dim = latent_dim + num_unit + emoji_dim
-                decoder_cell_no_drop = tf.nn.rnn_cell.MultiRNNCell(
-                    [create_rnn_cell(dim, 0, cell_type, num_gpu),
-                     create_rnn_cell(dim, 1, cell_type, num_gpu)])
-            else:
-                train_decoder_init_state = tf.concat([self.z_sample, ori_encoder_state_flat, emoji_vec], axis=1)
-                dim = latent_dim + 2 * num_unit + emoji_dim
-                decoder_cell_no_drop = create_rnn_cell(dim, 0, cell_type, num_gpu)
-
-            decoder_cell_no_drop = seq2seq.AttentionWrapper(
-                decoder_cell_no_drop,
-                attention_mechanism,
-                attention_layer_size=None)
+            train_decoder_init_state = self._decoder_init_state(
+                self.z_sample, ori_encoder_state, ori_encoder_state_flat, emoji_vec)
+            decoder_cell_no_drop = self._decoder_cell(attention_mechanism, num_gpu)
 
             decoder_cell = tf.contrib.rnn.DropoutWrapper(
                 cell=decoder_cell_no_drop, input_keep_prob=(1.0 - self.dropout))
 
             helper = seq2seq.TrainingHelper(
-                rep_input_emb, self.rep_len + 1, time_major=True)
-            projection_layer = layers_core.Dense(
-                vocab_size, use_bias=False, name="output_projection")
+                rep_input_emb, rep_len + 1, time_major=True)
+            projection_layer = self.projection_layer
             decoder = seq2seq.BasicDecoder(
                 decoder_cell, helper,
-                decoder_cell.zero_state(batch_size, tf.float32).clone(cell_state=train_decoder_init_state),
-                output_layer=projection_layer)
+                decoder_cell.zero_state(dynamic_batch_size, tf.float32).clone(cell_state=train_decoder_init_state),
+                # with sampled softmax, keep the cell outputs and only project them for the exact loss
+                output_layer=None if self.num_sampled > 0 else projection_layer)
             train_outputs, _, _ = seq2seq.dynamic_decode(
                 decoder,
                 output_time_major=True,
                 swap_memory=True,
                 scope=decoder_scope
             )
-            self.logits = train_outputs.rnn_output
+            if self.num_sampled > 0:
+                decoder_outputs = train_outputs.rnn_output  # [len, batch_size, output_size]
+                self.logits = projection_layer(decoder_outputs)
+            else:
+                self.logits = train_outputs.rnn_output
 
         with tf.variable_scope("decoder_infer") as decoder_scope:
             # normal_sample = tf.random_normal(shape=(batch_size, latent_dim))
-
-            if decoder_layer == 2:
-                infer_decoder_init_state = (
-                    tf.concat([self.q_z_sample, ori_encoder_state[0], emoji_vec], axis=1),
-                    tf.concat([self.q_z_sample, ori_encoder_state[1], emoji_vec], axis=1)
-                )
-            else:
-                infer_decoder_init_state = tf.concat([self.q_z_sample, ori_encoder_state_flat, emoji_vec], axis=1)
-
-            start_tokens = tf.fill([batch_size], start_i)
-            end_token = end_i
-
-            if beam_width > 0:
-                # Replicate encoder info beam_width times
-                infer_decoder_init_state = seq2seq.tile_batch(
-                    infer_decoder_init_state, multiplier=beam_width)
-                decoder = seq2seq.BeamSearchDecoder(
-                    cell=decoder_cell_no_drop,
-                    embedding=embedding.coder,
-                    start_tokens=start_tokens,
-                    end_token=end_token,
-                    initial_state=decoder_cell_no_drop.zero_state(
-                        batch_size, tf.float32).clone(cell_state=infer_decoder_init_state),
-                    beam_width=beam_width,
-                    output_layer=projection_layer,
-                    length_penalty_weight=0.0)
-            else:
-                helper = seq2seq.GreedyEmbeddingHelper(
-                    embedding.coder, start_tokens, end_token)
-                decoder = seq2seq.BasicDecoder(
-                    decoder_cell_no_drop,
-                    helper,
-                    decoder_cell_no_drop.zero_state(batch_size, tf.float32).clone(cell_state=infer_decoder_init_state),
-                    output_layer=projection_layer  # applied per timestep
-                )
-
-            # Dynamic decoding
-            infer_outputs, _, _ = seq2seq.dynamic_decode(
-                decoder,
-                maximum_iterations=maximum_iterations,
-                output_time_major=True,
-                swap_memory=True,
-                scope=decoder_scope
-            )
-            if beam_width > 0:
-                self.result = infer_outputs.predicted_ids
-            else:
-                self.result = infer_outputs.sample_id
+            infer_decoder_init_state = self._decoder_init_state(
+                self.q_z_sample, ori_encoder_state, ori_encoder_state_flat, emoji_vec)
+            self._decode_inference(
+                decoder_cell_no_drop, infer_decoder_init_state, dynamic_batch_size, ori_len, decoder_scope)
 
         with tf.variable_scope("loss"):
-            max_time = tf.shape(self.rep_output)[0]
+            max_time = tf.shape(rep_output)[0]
             with tf.variable_scope("reconstruction"):
                 # TODO: use inference decoder's logits to compute recon_loss
                 cross_entropy = tf.nn.sparse_softmax_cross_entropy_with_logits(  # ce = [len, batch_size]
-                    labels=self.rep_output, logits=self.logits)
+                    labels=rep_output, logits=self.logits)
                 # rep: [len, batch_size]; logits: [len, batch_size, vocab_size]
                 target_mask = tf.sequence_mask(
-                    self.rep_len + 1, max_time, dtype=self.logits.dtype)
+                    rep_len + 1, max_time, dtype=self.logits.dtype)
                 # time_major
                 target_mask_t = tf.transpose(target_mask)
-                self.recon_loss = tf.reduce_sum(cross_entropy * target_mask_t) / batch_size
+                self.recon_loss = tf.reduce_sum(cross_entropy * target_mask_t) / float_batch_size
+
+            if self.num_sampled > 0:
+                with tf.variable_scope("sampled_reconstruction"):
+                    output_size = decoder_cell.output_size
+                    # output_projection has no bias, its kernel is [vocab_size, output_size]
+                    sampled_cross_entropy = tf.nn.sampled_softmax_loss(
+                        weights=projection_layer.kernel,
+                        biases=tf.zeros([self.vocab_size]),
+                        labels=tf.reshape(tf.cast(rep_output, tf.int64), [-1, 1]),
+                        inputs=tf.reshape(decoder_outputs, [-1, output_size]),
+                        num_sampled=self.num_sampled,
+                        num_classes=self.vocab_size)
+                    sampled_cross_entropy = tf.reshape(sampled_cross_entropy, tf.shape(rep_output))
+                    self.train_recon_loss = tf.reduce_sum(sampled_cross_entropy * target_mask_t) / float_batch_size
+            else:
+                self.train_recon_loss = self.recon_loss
 
             with tf.variable_scope("latent"):
                 # without prior network
@@ -233,51 +304,215 @@ class CVAE(object):
                     tf.exp(self.log_var - self.p_log_var) +
                     (self.mu - self.p_mu) ** 2 / tf.exp(self.p_log_var) - 1. - self.log_var + self.p_log_var,
                     axis=0)
-                self.kl_loss = tf.reduce_mean(self.kl_loss)
+                # per example like the other losses (the last batch may be smaller), kept at the scale of
+                # the former sum over a full batch_size batch that kl_ceiling was tuned with
+                self.kl_loss = tf.reduce_mean(self.kl_loss) / float_batch_size * self.batch_size
 
             with tf.variable_scope("bow"):
                 # self.bow_loss = self.kl_weight * 0
-                mlp_b = layers_core.Dense(
-                    vocab_size, use_bias=False, name="MLP_b")
+                mlp_b = self.mlp_b
                 # is it a mistake that we only model on latent variable?
                 latent_logits = mlp_b(tf.concat(
                     [self.z_sample, ori_encoder_state_flat, emoji_vec], axis=1))  # [batch_size, vocab_size]
-                latent_logits = tf.expand_dims(latent_logits, 0)  # [1, batch_size, vocab_size]
-                latent_logits = tf.tile(latent_logits, [max_time, 1, 1])  # [max_time, batch_size, vocab_size]
+                latent_log_probs = tf.nn.log_softmax(latent_logits)
 
-                cross_entropy = tf.nn.sparse_softmax_cross_entropy_with_logits(  # ce = [len, batch_size]
-                    labels=self.rep_output, logits=latent_logits)
-                self.bow_loss = tf.reduce_sum(cross_entropy * target_mask_t) / batch_size
+                # every position shares one distribution: gather it at the targets instead of tiling it over time
+                batch_index = tf.tile(
+                    tf.expand_dims(tf.range(dynamic_batch_size), 0), [max_time, 1])  # [max_time, batch_size]
+                cross_entropy = -tf.gather_nd(  # ce = [len, batch_size]
+                    latent_log_probs, tf.stack([batch_index, rep_output], axis=2))
+                self.bow_loss = tf.reduce_sum(cross_entropy * target_mask_t) / float_batch_size
 
-            if is_seq2seq:
+            if self.is_seq2seq:
                 self.kl_loss = self.kl_loss - self.kl_loss
                 self.bow_loss = self.bow_loss - self.bow_loss
 
             self.loss = tf.reduce_mean(
-                self.recon_loss + self.kl_loss * self.kl_weight * kl_ceiling + self.bow_loss * bow_ceiling)
+                self.train_recon_loss + self.kl_loss * self.kl_weight * self.kl_ceiling +
+                self.bow_loss * self.bow_ceiling)
 
-        # Calculate and clip gradients
-        with tf.variable_scope("optimization"):
-            params = tf.trainable_variables()
-            gradients = tf.gradients(self.loss, params)
-            clipped_gradients, _ = tf.clip_by_global_norm(
-                gradients, max_gradient_norm)
+    def _build_inference(self, emoji, ori, ori_len, num_gpu):
+        """the generation path only: original tweet encoder, prior network and inference decoder
 
-            # Optimization
-            optimizer = tf.train.AdamOptimizer(lr)
-            self.update_step = optimizer.apply_gradients(
-                zip(clipped_gradients, params))
+        The decoder runs in the "decoder_train" scope, where the training graph
+        creates the decoder variables, so a training checkpoint restores it.
+        """
+        dynamic_batch_size = tf.shape(emoji)[0]
+
+        with tf.variable_scope("embeddings"):
+            ori_emb = self.embedding(ori)
+            emoji_emb = self.embedding(emoji)
+
+        ori_encoder_output, ori_encoder_state, ori_encoder_state_flat, emoji_vec, condition_flat = \
+            self._encode_condition(ori_emb, ori_len, emoji_emb, num_gpu)
+
+        self._prior_network(condition_flat)
 
-    def infer_and_eval(self, batches, sess):
+        with tf.variable_scope("reparameterization"):
+            self.q_z_sample = self.p_mu + tf.exp(self.p_log_var / 2.) * tf.random_normal(shape=tf.shape(self.p_mu))
+
+        if self.is_seq2seq:  # vanilla seq2seq
+            self.q_z_sample = self.q_z_sample - self.q_z_sample
+
+        attention_mechanism = self._attention_mechanism(ori_encoder_output, ori_len)
+
+        with tf.variable_scope("decoder_train") as decoder_scope:
+            infer_decoder_init_state = self._decoder_init_state(
+                self.q_z_sample, ori_encoder_state, ori_encoder_state_flat, emoji_vec)
+            decoder_cell_no_drop = self._decoder_cell(attention_mechanism, num_gpu)
+            self._decode_inference(
+                decoder_cell_no_drop, infer_decoder_init_state, dynamic_batch_size, ori_len, decoder_scope)
+        self.result = tf.identity(self.result, name="result")
+
+    def _encode_condition(self, ori_emb, ori_len, emoji_emb, num_gpu):
+        with tf.variable_scope("original_tweet_encoder"):
+            ori_encoder_output, ori_encoder_state = build_bidirectional_rnn(
+                self.num_unit, ori_emb, ori_len, self.cell_type, num_gpu, device_type=self.device_type,
+                fused=self.fused_encoder)
+            ori_encoder_state_flat = tf.concat(
+                [ori_encoder_state[0], ori_encoder_state[1]], axis=1)
+
+        emoji_vec = tf.layers.dense(emoji_emb, self.emoji_dim, activation=tf.nn.tanh, name="dense")
+        # emoji_vec = tf.ones([batch_size, emoji_dim], tf.float32)
+        condition_flat = tf.concat([ori_encoder_state_flat, emoji_vec], axis=1)
+        return ori_encoder_output, ori_encoder_state, ori_encoder_state_flat, emoji_vec, condition_flat
+
+    def _prior_network(self, condition_flat):
+        with tf.variable_scope("prior_network"):
+            # simpler prior network
+            # p_hidden = condition_flat
+            p_hidden = tf.layers.dense(
+                condition_flat, int(0.62 * self.latent_dim), activation=tf.nn.relu, name="r_net_hidden")
+            p_hidden_mu = tf.layers.dense(
+                p_hidden, int(0.77 * self.latent_dim), activation=tf.nn.relu, name="dense")
+            p_hidden_var = tf.layers.dense(
+                p_hidden, int(0.77 * self.latent_dim), activation=tf.nn.relu, name="dense_1")
+            self.p_mu = tf.layers.dense(
+                p_hidden_mu, self.latent_dim, activation=tf.nn.tanh, name="p_mean")
+            self.p_log_var = tf.layers.dense(
+                p_hidden_var, self.latent_dim, activation=tf.nn.tanh, name="p_log_var")
+
+    def _attention_mechanism(self, ori_encoder_output, ori_len):
+        with tf.variable_scope("attention"):
+            attention_state = tf.concat([ori_encoder_output[0], ori_encoder_output[1]], axis=2)
+            attention_state = tf.transpose(attention_state, [1, 0, 2])
+
+            return seq2seq.BahdanauAttention(
+                self.num_unit, attention_state, memory_sequence_length=ori_len)
+
+    def _decoder_init_state(self, z, ori_encoder_state, ori_encoder_state_flat, emoji_vec):
+        if self.decoder_layer == 2:
+            return (
+                tf.concat([z, ori_encoder_state[0], emoji_vec], axis=1),
+                tf.concat([z, ori_encoder_state[1], emoji_vec], axis=1)
+            )
+        return tf.concat([z, ori_encoder_state_flat, emoji_vec], axis=1)
+
+    def _decoder_cell(self, attention_mechanism, num_gpu):
+        if self.decoder_layer == 2:
+            dim = self.latent_dim + self.num_unit + self.emoji_dim
+            decoder_cell_no_drop = tf.nn.rnn_cell.MultiRNNCell(
+                [create_rnn_cell(dim, 0, self.cell_type, num_gpu, device_type=self.device_type),
+                 create_rnn_cell(dim, 1, self.cell_type, num_gpu, device_type=self.device_type)])
+        else:
+            dim = self.latent_dim + 2 * self.num_unit + self.emoji_dim
+            decoder_cell_no_drop = create_rnn_cell(dim, 0, self.cell_type, num_gpu, device_type=self.device_type)
+
+        return seq2seq.AttentionWrapper(
+            decoder_cell_no_drop,
+            attention_mechanism,
+            attention_layer_size=None)
+
+    def _decode_inference(self, decoder_cell_no_drop, infer_decoder_init_state, dynamic_batch_size, ori_len,
+                          decoder_scope):
+        start_tokens = tf.fill([dynamic_batch_size], self.start_i)
+        end_token = self.end_i
+
+        # decode budget: maximum_iterations, or with decode_length_ratio > 0 (greedy only) ratio * ori_len
+        # steps per tweet (at most maximum_iterations), the batch stops at its longest budget
+        if self.decode_length_ratio > 0:
+            limits = tf.ceil(self.decode_length_ratio * tf.cast(ori_len, tf.float32))
+            limits = tf.clip_by_value(tf.cast(limits, tf.int32), 1, self.maximum_iterations)
+            maximum_iterations = tf.reduce_max(limits)
+        else:
+            limits = None
+            maximum_iterations = self.maximum_iterations
+
+        if self.beam_width > 0:
+            # Replicate encoder info beam_width times
+            infer_decoder_init_state = seq2seq.tile_batch(
+                infer_decoder_init_state, multiplier=self.beam_width)
+            decoder = seq2seq.BeamSearchDecoder(
+                cell=decoder_cell_no_drop,
+                embedding=self.embedding.coder,
+                start_tokens=start_tokens,
+                end_token=end_token,
+                initial_state=decoder_cell_no_drop.zero_state(
+                    dynamic_batch_size * self.beam_width, tf.float32).clone(cell_state=infer_decoder_init_state),
+                beam_width=self.beam_width,
+                output_layer=self.projection_layer,
+                length_penalty_weight=0.0)
+        else:
+            if limits is None:
+                helper = seq2seq.GreedyEmbeddingHelper(
+                    self.embedding.coder, start_tokens, end_token)
+            else:  # a tweet is finished at its own budget, so the batch stops once all are done
+                helper = LengthLimitedGreedyHelper(
+                    self.embedding.coder, start_tokens, end_token, limits)
+            decoder = seq2seq.BasicDecoder(
+                decoder_cell_no_drop,
+                helper,
+                decoder_cell_no_drop.zero_state(
+                    dynamic_batch_size, tf.float32).clone(cell_state=infer_decoder_init_state),
+                output_layer=self.projection_layer  # applied per timestep
+            )
+
+        # Dynamic decoding
+        infer_outputs, _, _ = seq2seq.dynamic_decode(
+            decoder,
+            maximum_iterations=maximum_iterations,
+            output_time_major=True,
+            swap_memory=True,
+            scope=decoder_scope
+        )
+        if self.beam_width > 0:
+            self.result = infer_outputs.predicted_ids
+        else:
+            self.result = infer_outputs.sample_id
+
+        if limits is not None:
+            # the steps of a tweet after its budget (while others still decode) become </s>
+            steps = tf.range(tf.shape(self.result)[0])[:, None]
+            within = steps < limits[None, :]
+            self.result = tf.where(within, self.result, tf.fill(tf.shape(self.result), end_token))
+
+    def infer_and_eval(self, batches, sess, mode="both", keep_corpus=False, reference_index=None):
+        """mode: "loss" runs the teacher-forced losses only, "generate" the inference decoder only
+        (BLEU and generations), "both" does both in one pass. Metrics that the mode skips are None.
+
+        Batches are consumed one at a time and only metric sums are kept, the generations are
+        returned only with keep_corpus, otherwise as None. A bleu.ReferenceIndex of the responses
+        of the (unshuffled) batches spares extracting their n-grams again at every evaluation.
+        Generating sets self.decode_steps, the decoder steps the batches ran."""
+        assert mode in ("loss", "generate", "both")
         sess = sess or sess.get_default_session()
+        run_loss = mode != "generate"
+        run_generate = mode != "loss"
+
+        fetches = {}
+        if run_loss:
+            fetches.update(recon_loss=self.recon_loss, kl_loss=self.kl_loss, bow_loss=self.bow_loss)
+        if run_generate:
+            fetches["result"] = self.result
 
         # inference
-        reference_corpus = []
-        generation_corpus = []
+        bleu = BleuAccumulator()
+        decode_steps = 0
+        generation_corpus = [] if keep_corpus and run_generate else None
 
-        recon_loss_l = []
-        kl_loss_l = []
-        bow_loss_l = []
+        # losses are per-example means of each batch, summed weighted by batch size
+        recon_loss_sum = kl_loss_sum = bow_loss_sum = 0.
+        example_count = 0
         word_count = 0
 
         for batch in batches:
@@ -285,56 +520,94 @@ class CVAE(object):
             feed_dict[self.kl_weight] = 1.
             # feed_dict[self.inferring] = True
 
-            gen_digits, recon_loss, kl_loss, bow_loss = sess.run(
-                [self.result, self.recon_loss, self.kl_loss, self.bow_loss],
-                feed_dict=feed_dict)
-            recon_loss_l.append(recon_loss)
-            kl_loss_l.append(kl_loss)
-            bow_loss_l.append(bow_loss)
+            fetched = sess.run(fetches, feed_dict=feed_dict)
+            batch_size = len(batch[0])
+            batch_start = example_count
+            example_count += batch_size
 
             rep_m = batch[3]
             rep_len = batch[4]
-            for i, leng in enumerate(rep_len):
-                word_count += leng
-                ref = list(rep_m[0:leng, i])
-                reference_corpus.append([ref])
-
-                out = []
-                if self.beam_width > 0:
-                    for digit in gen_digits[:, i, 0]:
-                        if digit == self.end_i:
-                            break
-                        out.append(digit)
-                else:
-                    for digit in gen_digits[:, i]:
-                        if digit == self.end_i:
-                            break
-                        out.append(digit)
-                generation_corpus.append(out)
-
-        total_recon_loss = np.mean(recon_loss_l)
-        total_kl_loss = np.mean(kl_loss_l)
-        total_bow_loss_l = np.mean(bow_loss_l)
-        perplexity = safe_exp(total_recon_loss * self.batch_size * len(recon_loss_l) / word_count)
-
-        bleu_score, precisions, bp, ratio, translation_length, reference_length = compute_bleu(
-            reference_corpus, generation_corpus)
-        for i in range(len(precisions)):
-            precisions[i] *= 100
+            word_count += np.sum(rep_len)
+            if run_loss:
+                recon_loss_sum += fetched["recon_loss"] * batch_size
+                kl_loss_sum += fetched["kl_loss"] * batch_size
+                bow_loss_sum += fetched["bow_loss"] * batch_size
+            if not run_generate:
+                continue
+
+            gen_digits = fetched["result"]
+            decode_steps += gen_digits.shape[0]
+            if self.beam_width > 0:  # best beam
+                gen_digits = gen_digits[:, :, 0]
+            generations = truncate_generations(gen_digits, self.end_i)
+            if reference_index is not None:
+                bleu.add_indexed(reference_index, generations, batch_start)
+            else:
+                bleu.add([[list(rep_m[0:leng, i])] for i, leng in enumerate(rep_len)], generations)
+            if keep_corpus:
+                generation_corpus.extend(generations)
+
+        total_recon_loss = total_kl_loss = total_bow_loss_l = perplexity = None
+        if run_loss:
+            total_recon_loss = recon_loss_sum / example_count
+            total_kl_loss = kl_loss_sum / example_count
+            total_bow_loss_l = bow_loss_sum / example_count
+            perplexity = safe_exp(recon_loss_sum / word_count)
+
+        bleu_score = precisions = None
+        if run_generate:
+            self.decode_steps = decode_steps
+            bleu_score, precisions, bp, ratio, translation_length, reference_length = bleu.result()
+            bleu_score *= 100
+            for i in range(len(precisions)):
+                precisions[i] *= 100
 
         return (total_recon_loss, total_kl_loss, total_bow_loss_l,
-                perplexity, bleu_score * 100, precisions,
+                perplexity, bleu_score, precisions,
                 generation_corpus)
 
     def train_update(self, batch, sess, weight):
+        """one optimizer step on the batch, with accum_steps > 1 its micro-batches run one at a time"""
         sess = sess or sess.get_default_session()
+        if self.accum_steps > 1:
+            return self.accumulate_update(batch, sess, weight)
+
         feed_dict = dict(zip(self.placeholders, batch))
         feed_dict[self.kl_weight] = weight
 
         _, recon_loss, kl_loss, bow_loss = sess.run(
-            [self.update_step, self.recon_loss, self.kl_loss, self.bow_loss], feed_dict=feed_dict)
+            [self.update_step, self.train_recon_loss, self.kl_loss, self.bow_loss], feed_dict=feed_dict)
+        return recon_loss, kl_loss, bow_loss
+
+    def accumulate_update(self, batch, sess, weight):
+        # normalizing every micro-batch by the whole batch size makes the summed gradients
+        # and losses those of the whole batch
+        recon_loss = kl_loss = bow_loss = 0.
+        for micro_batch in split_micro_batches(batch, self.accum_steps):
+            feed_dict = dict(zip(self.placeholders, micro_batch))
+            feed_dict[self.kl_weight] = weight
+            feed_dict[self.loss_batch_size] = len(batch[0])
+
+            _, micro_recon_loss, micro_kl_loss, micro_bow_loss = sess.run(
+                [self.accumulate_step, self.train_recon_loss, self.kl_loss, self.bow_loss], feed_dict=feed_dict)
+            recon_loss += micro_recon_loss
+            kl_loss += micro_kl_loss
+            bow_loss += micro_bow_loss
+        sess.run(self.update_step)
         return recon_loss, kl_loss, bow_loss
 
+class FrozenCVAE(object):
+    """generation from the frozen inference graph that export.py writes, no checkpoint or model code needed"""
+    def __init__(self, path):
+        self.graph = load_frozen_graph(path)
+        self.placeholders = [self.graph.get_tensor_by_name(name) for name in
+                             ("emoji:0", "original_tweet:0", "original_tweet_length:0")]
+        self.result = self.graph.get_tensor_by_name("result:0")
+
+    def generate(self, batch, sess):
+        """sample ids [len, batch_size] for the emoji/original tweet part of a batch"""
+        return sess.run(self.result, feed_dict=dict(zip(self.placeholders, batch)))
+
 if __name__ == '__main__':
 
     from helpers import build_data, batch_generator, print_out, build_vocab
@@ -442,7 +715,7 @@ if __name__ == '__main__':
         # generate_graph()
         for epoch in range(start_epoch, num_epoch + 1):
             train_batches = batch_generator(
-                train_data, start_i, end_i, batch_size)
+                train_data, start_i, end_i, batch_size, lazy=True)
 
             recon_l = []
             kl_l = []
@@ -502,14 +775,15 @@ if __name__ == '__main__':
         """GENERATE"""
         # TRAIN SET
         train_batches = batch_generator(
-            train_data, start_i, end_i, batch_size, permutate=False)
+            train_data, start_i, end_i, batch_size, permutate=False, lazy=True)
         (train_recon_loss, train_kl_loss, train_bow_loss,
-         perplexity, train_bleu_score, precisions, generation_corpus) = cvae.infer_and_eval(train_batches, sess)
+         perplexity, train_bleu_score, precisions, generation_corpus) = cvae.infer_and_eval(
+            train_batches, sess, keep_corpus=True)
         write_out(train_out_f, generation_corpus)
         print_out("BEST TRAIN BLEU: %.1f" % train_bleu_score, f=log_f)
 
         # TEST SET
-        generation_corpus = cvae.infer_and_eval(test_batches, sess)[-1]
+        generation_corpus = cvae.infer_and_eval(test_batches, sess, keep_corpus=True)[-1]
         write_out(test_out_f, generation_corpus)
 
     log_f.close()
@@ -1,5 +1,7 @@
 import tensorflow as tf
 from model_helpers import Embedding, build_bidirectional_rnn, xavier
+from model_helpers import add_profile_arguments, resolve_profile, session_config
+from model_helpers import tower_devices, split_batch, sum_gradients, create_optimizer
 import os
 from os import makedirs
 from os.path import join, dirname
@@ -13,36 +15,70 @@ class TweetDiscriminator(object):
     def __init__(self, num_unit, batch_size, vocab_size, embed_size,
                  cell_type=tf.nn.rnn_cell.BasicLSTMCell,
                  num_gpu=2,
-                 lr=0.001):
-
-        self.label = tf.placeholder(tf.int32, shape=[batch_size], name="label")
-        self.text = tf.placeholder(tf.int32, shape=[None, batch_size], name="embed-tweet")  # [max_len, batch_size]
-        self.len = tf.placeholder(tf.int32, shape=[batch_size], name="tweet_length")
+                 lr=0.001,
+                 device_type="gpu",
+                 num_tower=1,
+                 optimizer="adam"):
+        self.num_unit = num_unit
+        self.cell_type = cell_type
+
+        # batch_size is only nominal, any batch size can be fed
+        self.label = tf.placeholder(tf.int32, shape=[None], name="label")
+        self.text = tf.placeholder(tf.int32, shape=[None, None], name="embed-tweet")  # [max_len, batch_size]
+        self.len = tf.placeholder(tf.int32, shape=[None], name="tweet_length")
 
         with tf.variable_scope("embeddings"):
-            embedding = Embedding(vocab_size, embed_size)
-            text_embed = embedding(self.text)
+            self.embedding = Embedding(vocab_size, embed_size)
+
+        float_batch_size = tf.cast(tf.shape(self.label)[0], tf.float32)
+        # lazy_adam only updates the embedding rows a batch uses, see create_optimizer
+        optimizer = create_optimizer(optimizer, lr)
+        if num_tower == 1:
+            self._build_tower(self.text, self.len, self.label, float_batch_size, num_gpu, device_type)
+            with tf.variable_scope("optimization"):
+                self.update_step = optimizer.minimize(self.loss)
+        else:
+            towers = []
+            tower_grads = []
+            tower_inputs = split_batch([self.text, self.len, self.label], [1, 0, 0], num_tower)
+            for i, device in enumerate(tower_devices(device_type, num_tower)):
+                with tf.device(device), tf.name_scope("tower_%d" % i), \
+                        tf.variable_scope(tf.get_variable_scope(), reuse=i > 0):
+                    text, length, label = tower_inputs[i]
+                    self._build_tower(text[:tf.reduce_max(length)], length, label, float_batch_size, 0, device_type)
+                    towers.append((self.prob, self.loss, self.accuracy))
+                    if i == 0:
+                        params = tf.trainable_variables()
+                    tower_grads.append(tf.gradients(self.loss, params, colocate_gradients_with_ops=True))
+
+            probs, losses, accuracies = zip(*towers)
+            self.prob = tf.concat(probs, axis=0)
+            # tower values are normalized by the whole batch size
+            self.loss = tf.add_n(losses)
+            self.accuracy = tf.add_n(accuracies)
+            with tf.variable_scope("optimization"):
+                self.update_step = optimizer.apply_gradients(zip(sum_gradients(tower_grads), params))
+
+    def _build_tower(self, text, length, label, float_batch_size, num_gpu, device_type):
+        with tf.variable_scope("embeddings"):
+            text_embed = self.embedding(text)
 
         with tf.variable_scope("text-encoder"):
             _, encoder_state = build_bidirectional_rnn(
-                num_unit, text_embed, self.len, cell_type, num_gpu)
+                self.num_unit, text_embed, length, self.cell_type, num_gpu, device_type=device_type)
             text_vec = tf.concat([encoder_state[0], encoder_state[1]], axis=1)
 
         with tf.variable_scope("turing-result"):
-            logits = tf.layers.dense(text_vec, 2, activation=None, kernel_initializer=xavier)
+            logits = tf.layers.dense(text_vec, 2, activation=None, kernel_initializer=xavier, name="dense")
             self.prob = tf.nn.softmax(logits)
 
         with tf.variable_scope("loss"):
-            self.loss = tf.reduce_mean(
-                tf.nn.sparse_softmax_cross_entropy_with_logits(labels=self.label, logits=logits))
+            self.loss = tf.reduce_sum(
+                tf.nn.sparse_softmax_cross_entropy_with_logits(labels=label, logits=logits)) / float_batch_size
 
         with tf.variable_scope("accuracy"):
-            accuracy = tf.nn.in_top_k(logits, self.label, k=1)
-            self.accuracy = tf.reduce_mean(tf.cast(accuracy, tf.float32))
-
-        with tf.variable_scope("optimization"):
-            optimizer = tf.train.AdamOptimizer(lr)
-            self.update_step = optimizer.minimize(self.loss)
+            accuracy = tf.nn.in_top_k(logits, label, k=1)
+            self.accuracy = tf.reduce_sum(tf.cast(accuracy, tf.float32)) / float_batch_size
 
     def train_update(self, batch, sess):
         sess = sess or sess.get_default_session()
@@ -59,6 +95,7 @@ class TweetDiscriminator(object):
         sess = sess or sess.get_default_session()
         loss_l = []
         accuracy_l = []
+        batch_size_l = []
 
         for batch in batches:
             text = batch[0]
@@ -71,12 +108,22 @@ class TweetDiscriminator(object):
 
             loss_l.append(loss)
             accuracy_l.append(accuracy)
-        return float(np.mean(loss_l)), float(np.mean(accuracy_l))
+            batch_size_l.append(len(label))
+        # the last batch may be smaller
+        return float(np.average(loss_l, weights=batch_size_l)), float(np.average(accuracy_l, weights=batch_size_l))
 
 if __name__ == '__main__':
+    import argparse
     from params.full import *
     num_epoch = 6
     test_step = 50
+    num_gpu = 2
+
+    dis_parser = argparse.ArgumentParser()
+    add_profile_arguments(dis_parser)
+    FLAGS, _ = dis_parser.parse_known_args()
+    device_type, num_gpu, intra_op_threads, inter_op_threads = resolve_profile(
+        FLAGS, device_type, num_gpu, intra_op_threads, inter_op_threads)
 
     # for machine samples
     from collections import Counter
@@ -91,11 +138,12 @@ if __name__ == '__main__':
     vocab_size = len(word2index)
 
     discriminator = TweetDiscriminator(num_unit, batch_size, vocab_size, embed_size,
-                                       cell_type=tf.nn.rnn_cell.GRUCell, num_gpu=2, lr=0.001)
+                                       cell_type=tf.nn.rnn_cell.GRUCell, num_gpu=num_gpu, lr=0.001,
+                                       device_type=device_type, num_tower=num_tower, optimizer=optimizer)
     
     train_data = build_dis_data("human_train.txt", "machine_train.txt", word2index)
     test_data = build_dis_data("human_test.txt", "machine_test.txt", word2index)
-    test_batches = generate_dis_batches(test_data, batch_size, False)
+    test_batches = generate_dis_batches(test_data, batch_size, False, min_batch_size=num_tower)
 
     print_out("*** DATA READY ***")
 
@@ -103,7 +151,8 @@ if __name__ == '__main__':
     log_f = open(join(output_dir, "log.log"), "w")
 
     saver = tf.train.Saver()
-    with tf.Session() as sess:
+    num_device = max(num_gpu, num_tower)
+    with tf.Session(config=session_config(device_type, num_device, intra_op_threads, inter_op_threads)) as sess:
         best_f = join(output_dir, "best_accuracy.txt")
 
         global_step = best_step = 1
@@ -112,7 +161,7 @@ if __name__ == '__main__':
         sess.run(tf.global_variables_initializer())
 
         for epoch in range(start_epoch, num_epoch + 1):
-            train_batches = generate_dis_batches(train_data, batch_size, True)
+            train_batches = generate_dis_batches(train_data, batch_size, True, min_batch_size=num_tower)
 
             loss_l = []
             accuracy_l = []
@@ -0,0 +1,57 @@
+"""exports the best checkpoint of a training run as a frozen inference graph
+
+usage: python export.py --input_dir <data dir> --run_dir <output dir of run.py> --param_set tiny [--output cvae.pb]
+
+The graph takes emoji [batch_size], original_tweet [len, batch_size] and
+original_tweet_length [batch_size] and returns the sample ids as result,
+see cvae.FrozenCVAE.
+"""
+import argparse
+import importlib
+from os.path import join
+from time import time
+
+import tensorflow as tf
+
+from cvae import CVAE, FrozenCVAE
+from helpers import build_vocab, print_out
+from model_helpers import freeze_graph, session_config
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_dir", type=str, required=True, help="""\
+        data directory holding vocab.ori""")
+    parser.add_argument("--run_dir", type=str, required=True, help="""\
+        output directory of the training run, relative to input_dir""")
+    parser.add_argument("--param_set", type=str, required=True, help="""\
+        tiny/medium/full, the one the run was trained with""")
+    parser.add_argument("--is_seq2seq", action="store_true")
+    parser.add_argument("--output", type=str, default="cvae.pb", help="""\
+        written to run_dir""")
+    FLAGS, _ = parser.parse_known_args()
+
+    params = importlib.import_module("params.%s" % FLAGS.param_set)
+    run_dir = join(FLAGS.input_dir, FLAGS.run_dir)
+
+    word2index, index2word = build_vocab(join(FLAGS.input_dir, "vocab.ori"))
+    start_i, end_i = word2index['<s>'], word2index['</s>']
+
+    start = time()
+    cvae = CVAE(len(word2index), params.embed_size, params.num_unit, params.latent_dim, params.emoji_dim,
+                params.batch_size, 1., 1., params.decoder_layer, start_i, end_i, params.beam_width,
+                params.maximum_iterations, params.max_gradient_norm, params.lr, params.dropout, params.num_gpu,
+                params.cell_type, FLAGS.is_seq2seq, device_type=params.device_type,
+                fused_encoder=params.fused_encoder,
+                decode_length_ratio=params.decode_length_ratio, infer_only=True)
+    # only the variables of the inference graph are restored from the training checkpoint
+    saver = tf.train.Saver()
+    with tf.Session(config=session_config(
+            params.device_type, params.num_gpu, params.intra_op_threads, params.inter_op_threads)) as sess:
+        saver.restore(sess, join(run_dir, "breakpoints/best_test_bleu.ckpt"))
+        print_out("inference graph restored in %.1f s" % (time() - start))
+        graph_def = freeze_graph(sess, ["result"], join(run_dir, FLAGS.output))
+    print_out("frozen graph: %d nodes, %.1f MB" % (len(graph_def.node), graph_def.ByteSize() / 2. ** 20))
+
+    start = time()
+    FrozenCVAE(join(run_dir, FLAGS.output))
+    print_out("frozen graph loaded in %.1f s" % (time() - start))
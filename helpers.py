@@ -1,11 +1,22 @@
 import numpy as np
-import random
 import tensorflow as tf
 tf.logging.set_verbosity(tf.logging.DEBUG)
 import math
 import sys
+import os
+import shutil
+import hashlib
+import io
+import multiprocessing
+import queue
+import threading
+from itertools import chain
+from os import makedirs
+from os.path import join, dirname, basename, abspath, isdir
 from time import gmtime, strftime
 
+from bleu import ReferenceIndex
+
 """build data"""
 def build_emoji_index(vocab_path, emoji_list):
     vocab_file = open(vocab_path, encoding="utf-8")
@@ -35,8 +46,51 @@ def build_vocab(vocab_path):
         word2index[word] = index
     return word2index, index2word
 
-def build_data(ori_path, rep_path, word2index):
-    unk_i = word2index['<unk>']
+def build_data(ori_path, rep_path, word2index, use_cache=True, num_workers=1):
+    """[emojis, ori_seqs, rep_seqs] as an int32 array and two Raggeds
+
+    With use_cache the token ids are read from a memory-mapped cache next to the
+    input files, which is (re)built whenever the inputs or the vocab change.
+    num_workers > 1 tokenizes in that many processes.
+    """
+    if not use_cache:
+        return read_data(ori_path, rep_path, word2index, num_workers)
+
+    def build_arrays():
+        emojis, ori_seqs, rep_seqs = read_data(ori_path, rep_path, word2index, num_workers)
+        return {
+            "emojis": emojis,
+            "ori_tokens": ori_seqs.tokens, "ori_offsets": ori_seqs.offsets,
+            "rep_tokens": rep_seqs.tokens, "rep_offsets": rep_seqs.offsets}
+
+    arrays = cached_corpus(corpus_cache_dir([ori_path, rep_path], word2index), build_arrays)
+    return [
+        arrays["emojis"],
+        Ragged(arrays["ori_tokens"], arrays["ori_offsets"]),
+        Ragged(arrays["rep_tokens"], arrays["rep_offsets"])
+    ]
+
+def build_reference_index(ori_path, rep_path, rep_seqs, word2index, use_cache=True):
+    """ReferenceIndex of the responses of a data set (one reference each) for BLEU
+
+    With use_cache it is saved next to the corpus cache and rebuilt like it. It is
+    keyed by both files, as the pairs kept in rep_seqs depend on the original tweets too.
+    """
+    rep_seqs = as_ragged(rep_seqs)
+    if not use_cache:
+        return ReferenceIndex.from_flat(
+            rep_seqs.flat_tokens, rep_seqs.offsets - rep_seqs.offsets[0], np.arange(len(rep_seqs)))
+
+    name, fingerprint = corpus_cache_dir([ori_path, rep_path], word2index).rsplit("-", 1)
+    cache_dir = "%s.ngrams-%s" % (name, fingerprint)
+    index = ReferenceIndex.from_arrays(cached_corpus(
+        cache_dir, lambda: build_reference_index(ori_path, rep_path, rep_seqs, word2index, False).arrays()))
+    assert len(index) == len(rep_seqs), "stale reference index %s" % cache_dir
+    return index
+
+def read_data(ori_path, rep_path, word2index, num_workers=1):
+    if num_workers > 1:
+        return read_data_parallel(ori_path, rep_path, word2index, num_workers)
 
     ori_file = open(ori_path, encoding="utf-8")
     ori_tweets = ori_file.readlines()
@@ -47,6 +101,17 @@ def build_data(ori_path, rep_path, word2index):
     rep_file.close()
 
     assert(len(ori_tweets) == len(rep_tweets))
+    emojis, ori_seqs, rep_seqs = tokenize_tweets(ori_tweets, rep_tweets, word2index)
+
+    return [
+        np.array(emojis, dtype=np.int32),
+        Ragged.from_seqs(ori_seqs),
+        Ragged.from_seqs(rep_seqs)
+    ]
+
+def tokenize_tweets(ori_tweets, rep_tweets, word2index):
+    unk_i = word2index['<unk>']
+
     emojis = []
     ori_seqs = []
     rep_seqs = []
@@ -65,45 +130,286 @@ def build_data(ori_path, rep_path, word2index):
         rep_seqs.append(rep_tweet)
         emojis.append(word2index.get(ori_words[0], unk_i))
 
+    return emojis, ori_seqs, rep_seqs
+
+"""parallel ingest"""
+INGEST_BLOCK_SIZE = 1 << 24
+
+def read_data_parallel(ori_path, rep_path, word2index, num_workers, chunks_per_worker=4):
+    """read_data with tokenization spread over worker processes
+
+    train.ori is cut into byte ranges aligned on line starts, and train.rep at
+    the same line numbers. Chunks are tokenized independently and concatenated
+    in file order, so the result equals read_data's.
+    """
+    ori_size = os.path.getsize(ori_path)
+    rep_size = os.path.getsize(rep_path)
+
+    num_chunks = num_workers * chunks_per_worker
+    ori_starts = [0]
+    with open(ori_path, "rb") as f:
+        for k in range(1, num_chunks):
+            f.seek(ori_size * k // num_chunks)
+            f.readline()  # move on to the next line start
+            if ori_starts[-1] < f.tell() < ori_size:
+                ori_starts.append(f.tell())
+    rep_starts = line_start_offsets(rep_path, count_lines_before(ori_path, ori_starts))
+
+    ori_ranges = list(zip(ori_starts, ori_starts[1:] + [ori_size]))
+    rep_ranges = list(zip(rep_starts, rep_starts[1:] + [rep_size]))
+    jobs = [(ori_path, ori_range, rep_path, rep_range) for ori_range, rep_range in zip(ori_ranges, rep_ranges)]
+
+    with multiprocessing.Pool(num_workers, initializer=_init_ingest_worker, initargs=(word2index,)) as pool:
+        chunks = pool.map(_tokenize_chunk, jobs)
+
     return [
-        emojis,
-        ori_seqs,
-        rep_seqs
+        np.concatenate([chunk[0] for chunk in chunks]),
+        concat_ragged([chunk[1] for chunk in chunks]),
+        concat_ragged([chunk[2] for chunk in chunks])
     ]
 
+def line_ends(block, next_byte):
+    """offsets in block right after each line end, with the universal newlines of text-mode reading
+    ("\\n", "\\r\\n" and a lone "\\r"); next_byte is the byte after the block, b"" at the end of the file"""
+    chars = np.frombuffer(block, dtype=np.uint8)
+    following = np.frombuffer(block[1:] + (next_byte[:1] or b"\0"), dtype=np.uint8)
+    lone_cr = (chars == ord("\r")) & (following != ord("\n"))
+    return np.flatnonzero((chars == ord("\n")) | lone_cr) + 1
+
+def _read_block(f, size):
+    """a block of f and the byte after it, without consuming that byte"""
+    block = f.read(size)
+    next_byte = f.read(1)
+    if next_byte:
+        f.seek(-1, os.SEEK_CUR)
+    return block, next_byte
+
+def count_lines_before(path, offsets):
+    """number of lines before each of the sorted byte offsets, which are line starts"""
+    counts = []
+    seen = pos = 0
+    with open(path, "rb") as f:
+        for offset in offsets:
+            while pos < offset:
+                block, next_byte = _read_block(f, min(INGEST_BLOCK_SIZE, offset - pos))
+                if not block:
+                    break
+                seen += len(line_ends(block, next_byte))
+                pos += len(block)
+            counts.append(seen)
+    return counts
+
+def line_start_offsets(path, line_numbers):
+    """byte offset where each of the sorted line numbers starts (file size past the end)"""
+    offsets = []
+    seen = pos = 0
+    with open(path, "rb") as f:
+        while len(offsets) < len(line_numbers) and line_numbers[len(offsets)] == 0:
+            offsets.append(0)
+        while len(offsets) < len(line_numbers):
+            block, next_byte = _read_block(f, INGEST_BLOCK_SIZE)
+            if not block:
+                break
+            ends = line_ends(block, next_byte)
+            # line n starts right after the n-th line end
+            while len(offsets) < len(line_numbers) and line_numbers[len(offsets)] <= seen + len(ends):
+                offsets.append(pos + int(ends[line_numbers[len(offsets)] - seen - 1]))
+            seen += len(ends)
+            pos += len(block)
+    return offsets + [pos] * (len(line_numbers) - len(offsets))
+
+_ingest_word2index = None
+
+def _init_ingest_worker(word2index):
+    global _ingest_word2index
+    _ingest_word2index = word2index
+
+def _read_lines(path, byte_range):
+    with open(path, "rb") as f:
+        f.seek(byte_range[0])
+        text = f.read(byte_range[1] - byte_range[0]).decode("utf-8")
+    # the line splitting of read_data's text-mode readlines
+    return io.StringIO(text, newline=None).readlines()
+
+def _tokenize_chunk(job):
+    ori_path, ori_range, rep_path, rep_range = job
+    ori_tweets = _read_lines(ori_path, ori_range)
+    rep_tweets = _read_lines(rep_path, rep_range)
+    assert(len(ori_tweets) == len(rep_tweets))
+
+    emojis, ori_seqs, rep_seqs = tokenize_tweets(ori_tweets, rep_tweets, _ingest_word2index)
+    return np.array(emojis, dtype=np.int32), Ragged.from_seqs(ori_seqs), Ragged.from_seqs(rep_seqs)
+
+def take_data(data_l, indices):
+    """the examples of [emojis, ori_seqs, rep_seqs] at indices, in that order"""
+    return [
+        np.asarray(data_l[0])[indices],
+        as_ragged(data_l[1]).take(indices),
+        as_ragged(data_l[2]).take(indices)
+    ]
+
+"""corpus cache"""
+CACHE_DIR_NAME = "corpus_cache"
+
+def corpus_cache_dir(paths, word2index):
+    """cache directory of a corpus, keyed by its source files and vocab
+
+    Source files are fingerprinted by path, size and mtime rather than by
+    content, so that checking the cache stays cheap for multi-GB inputs.
+    """
+    h = hashlib.sha1()
+    for path in paths:
+        st = os.stat(path)
+        h.update(("%s\t%d\t%d\n" % (abspath(path), st.st_size, st.st_mtime_ns)).encode("utf-8"))
+    for word, _ in sorted(word2index.items(), key=lambda x: x[1]):
+        h.update((word + "\n").encode("utf-8"))
+    name = "%s-%s" % ("+".join(basename(path) for path in paths), h.hexdigest()[:16])
+    return join(dirname(abspath(paths[0])), CACHE_DIR_NAME, name)
+
+def cached_corpus(cache_dir, build_arrays):
+    """the arrays cached in cache_dir, built with build_arrays() and saved there first if missing
+
+    If the cache can't be written, e.g. next to read-only inputs, the built arrays
+    are returned from memory and the next run builds them again.
+    """
+    if not isdir(cache_dir):
+        arrays = build_arrays()
+        if not save_corpus_cache(cache_dir, arrays):
+            print_out("cannot write the corpus cache %s, continuing uncached" % cache_dir)
+            return arrays
+    return load_corpus_cache(cache_dir)
+
+def save_corpus_cache(cache_dir, arrays):
+    """returns whether cache_dir holds the cache, False if it couldn't be written"""
+    # write into a temp dir and rename, so that readers never see a partial cache
+    tmp_dir = "%s.tmp%d" % (cache_dir, os.getpid())
+    try:
+        makedirs(tmp_dir, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(join(tmp_dir, name + ".npy"), array)
+        os.rename(tmp_dir, cache_dir)
+    except OSError:  # read-only or full, or built concurrently by another process
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return isdir(cache_dir)
+
+    # drop stale caches of the same files
+    prefix = basename(cache_dir).rsplit("-", 1)[0] + "-"
+    for name in os.listdir(dirname(cache_dir)):
+        path = join(dirname(cache_dir), name)
+        if name.startswith(prefix) and path != cache_dir and ".tmp" not in name:
+            shutil.rmtree(path, ignore_errors=True)
+    return True
+
+def load_corpus_cache(cache_dir):
+    arrays = {}
+    for fname in os.listdir(cache_dir):
+        if fname.endswith(".npy"):
+            arrays[fname[:-len(".npy")]] = np.load(join(cache_dir, fname), mmap_mode="r")
+    return arrays
+
+"""batch packing"""
+class Ragged(object):
+    """Variable-length int sequences stored as one flat token array plus offsets.
+
+    The i-th sequence is tokens[offsets[i]:offsets[i + 1]]. Sequences are laid
+    out contiguously and in order, so slicing only has to slice the offsets.
+    """
+    def __init__(self, tokens, offsets):
+        self.tokens = tokens
+        self.offsets = offsets
+
+    @classmethod
+    def from_seqs(cls, seqs):
+        lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+        offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        tokens = np.fromiter(chain.from_iterable(seqs), dtype=np.int32, count=offsets[-1])
+        return cls(tokens, offsets)
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    @property
+    def flat_tokens(self):
+        return self.tokens[self.offsets[0]:self.offsets[-1]]
+
+    def take(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        lengths = self.lengths[indices]
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        # position of every output token in self.tokens
+        positions = np.repeat(self.offsets[indices] - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return Ragged(self.tokens[positions], offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                return self.take(np.arange(start, stop, step))
+            return Ragged(self.tokens, self.offsets[start:max(start, stop) + 1])
+        if isinstance(i, (int, np.integer)):
+            if i < 0:
+                i += len(self)
+            if not 0 <= i < len(self):
+                raise IndexError("sequence index out of range")
+            return self.tokens[self.offsets[i]:self.offsets[i + 1]]
+        return self.take(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.tokens[self.offsets[i]:self.offsets[i + 1]]
+
+def as_ragged(seqs):
+    if isinstance(seqs, Ragged):
+        return seqs
+    return Ragged.from_seqs(seqs)
+
+def concat_ragged(parts):
+    lengths = np.concatenate([part.lengths for part in parts])
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return Ragged(np.concatenate([part.flat_tokens for part in parts]), offsets)
+
+def pack_time_major(seqs, extra_rows=0):
+    """zero-padded [max_len + extra_rows, num_seqs] int32 matrix of a Ragged"""
+    lengths = seqs.lengths
+    matrix = np.zeros([np.max(lengths) + extra_rows, len(seqs)], dtype=np.int32)
+    # matrix.T is batch-major, so its row-major mask order is the flat token order
+    mask = np.arange(matrix.shape[0]) < lengths[:, None]
+    matrix.T[mask] = seqs.flat_tokens
+    return matrix
+
 def generate_one_batch(data_l, start_i, end_i, s, e):
     emojis = data_l[0]
-    ori_seqs = data_l[1]
-    rep_seqs = data_l[2]
+    ori_seqs = as_ragged(data_l[1][s:e])
+    rep_seqs = as_ragged(data_l[2][s:e])
 
     if e is None:
         e = len(emojis)
 
     emoji_vec = np.array(emojis[s:e], dtype=np.int32)
 
-    ori_lengths = np.array([len(seq) for seq in ori_seqs[s:e]])
-    max_ori_len = np.max(ori_lengths)
+    ori_lengths = ori_seqs.lengths
     min_ori_len = np.min(ori_lengths)
     assert(min_ori_len > 0)
-    ori_matrix = np.zeros([max_ori_len, e - s], dtype=np.int32)
-
-    for i, seq in enumerate(ori_seqs[s:e]):
-        for j, elem in enumerate(seq):
-            ori_matrix[j, i] = elem
+    ori_matrix = pack_time_major(ori_seqs)
 
-    rep_lengths = np.array([len(seq) for seq in rep_seqs[s:e]])
-    max_rep_len = np.max(rep_lengths)
-    rep_matrix = np.zeros([max_rep_len, e - s], dtype=np.int32)
+    rep_lengths = rep_seqs.lengths
+    rep_matrix = pack_time_major(rep_seqs)
+    max_rep_len = rep_matrix.shape[0]
     rep_input_matrix = np.zeros([max_rep_len + 1, e - s], dtype=np.int32)
     rep_output_matrix = np.zeros([max_rep_len + 1, e - s], dtype=np.int32)
 
+    # <s> shifts the response down by one step, </s> closes it right after its last word
     rep_input_matrix[0, :] = start_i
-    for i, seq in enumerate(rep_seqs[s:e]):
-        for j, elem in enumerate(seq):
-            rep_matrix[j, i] = elem
-            rep_input_matrix[j + 1, i] = elem
-            rep_output_matrix[j, i] = elem
-        rep_output_matrix[len(seq), i] = end_i
+    rep_input_matrix[1:, :] = rep_matrix
+    rep_output_matrix[:-1, :] = rep_matrix
+    rep_output_matrix[rep_lengths, np.arange(e - s)] = end_i
 
     return [
             emoji_vec,
@@ -115,33 +421,171 @@ def generate_one_batch(data_l, start_i, end_i, s, e):
             rep_output_matrix
     ]
 
-def batch_generator(data_l, start_i, end_i, batch_size, permutate=True):
+def split_micro_batches(batch, num_splits):
+    """splits a batch of generate_one_batch into up to num_splits micro-batches of near-equal size,
+    each without the padding rows that only its longer tweets in the other micro-batches needed"""
+    emoji_vec, ori_matrix, ori_lengths, rep_matrix, rep_lengths, rep_input_matrix, rep_output_matrix = batch
+    micro_batches = []
+    for index in np.array_split(np.arange(len(emoji_vec)), min(num_splits, len(emoji_vec))):
+        s, e = index[0], index[-1] + 1
+        max_ori_len = np.max(ori_lengths[s:e])
+        max_rep_len = np.max(rep_lengths[s:e])
+        micro_batches.append([
+            emoji_vec[s:e],
+            ori_matrix[:max_ori_len, s:e],
+            ori_lengths[s:e],
+            rep_matrix[:max_rep_len, s:e],
+            rep_lengths[s:e],
+            rep_input_matrix[:max_rep_len + 1, s:e],
+            rep_output_matrix[:max_rep_len + 1, s:e]
+        ])
+    return micro_batches
+
+class LazyBatches(object):
+    """Replayable view of one epoch of batches, each packed when it is reached.
+
+    Only the example order and the batch bounds are kept, so iterating holds a
+    single batch at a time and every pass yields the same batches again.
+    """
+    def __init__(self, data_l, start_i, end_i, order, bounds):
+        self.data_l = data_l
+        self.start_i = start_i
+        self.end_i = end_i
+        self.order = order  # None keeps the data order
+        self.bounds = bounds
+
+    def __len__(self):
+        return len(self.bounds)
+
+    def padding_ratio(self):
+        """fraction of the packed ori/rep matrices that is padding"""
+        ori_lengths = as_ragged(self.data_l[1]).lengths
+        rep_lengths = as_ragged(self.data_l[2]).lengths
+        real = padded = 0
+        for s, e in self.bounds:
+            indices = np.arange(s, e) if self.order is None else self.order[s:e]
+            for lengths in (ori_lengths[indices], rep_lengths[indices]):
+                real += np.sum(lengths)
+                padded += np.max(lengths) * len(lengths)
+        return 1. - float(real) / padded
+
+    def __iter__(self):
+        for s, e in self.bounds:
+            if self.order is None:
+                yield generate_one_batch(self.data_l, self.start_i, self.end_i, s, e)
+            else:
+                batch_data = take_data(self.data_l, self.order[s:e])
+                yield generate_one_batch(batch_data, self.start_i, self.end_i, 0, None)
+
+def batch_generator(data_l, start_i, end_i, batch_size, permutate=True, lazy=False, bucket_chunk=0,
+                    min_batch_size=1):
+    """batches of one epoch: a list, or a LazyBatches view when lazy
+
+    With bucket_chunk > 0 (and permutate), the shuffled examples are sorted by
+    length within chunks of bucket_chunk batches, so that every batch holds
+    tweets of similar length, and the batch order is shuffled afterwards.
+    A last batch smaller than min_batch_size (e.g. the number of towers) is
+    merged into the one before it.
+    """
+    data_size = len(data_l[0])
     # shuffle
-    emojis = data_l[0]
-    ori_seqs = data_l[1]
-    rep_seqs = data_l[2]
-
-    if permutate:
-        all_input = list(zip(emojis, ori_seqs, rep_seqs))
+    order = np.random.permutation(data_size) if permutate else None
+
+    if order is not None and bucket_chunk > 0:
+        ori_lengths = as_ragged(data_l[1]).lengths
+        rep_lengths = as_ragged(data_l[2]).lengths
+        chunk_size = bucket_chunk * batch_size
+        for s in range(0, data_size, chunk_size):
+            chunk = order[s:s + chunk_size]
+            # responses (decoder steps and logits) first, originals break ties
+            order[s:s + chunk_size] = chunk[np.lexsort((ori_lengths[chunk], rep_lengths[chunk]))]
+
+    # the last batch keeps the remainder instead of repeating examples of the previous one
+    bounds = [(s, min(s + batch_size, data_size)) for s in range(0, data_size, batch_size)]
+    bounds = merge_small_tail(bounds, min_batch_size)
+
+    if order is not None and bucket_chunk > 0:
+        # np.random only, so that one np.random.seed makes the batch order reproducible
+        bounds = [bounds[i] for i in np.random.permutation(len(bounds))]
+
+    batches = LazyBatches(data_l, start_i, end_i, order, bounds)
+    if lazy:
+        return batches
+    return list(batches)
+
+class Prefetcher(object):
+    """Iterates over batches that a background thread builds ahead of time.
+
+    Up to `size` ready batches wait in a bounded queue, so batch packing in
+    Python overlaps with sess.run (which releases the GIL). Every iteration
+    starts a new pass over `batches`, so a replayable view stays replayable.
+    """
+    _END = object()
+
+    def __init__(self, batches, size=8):
+        self.batches = batches
+        self.size = size
+
+    def __len__(self):
+        return len(self.batches)
+
+    @staticmethod
+    def _put(ready, stop, item):
+        """puts item unless the consumer stops first, returns whether it was put"""
+        while not stop.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _fill(self, ready, stop):
+        try:
+            for batch in self.batches:
+                if not self._put(ready, stop, batch):
+                    return
+            self._put(ready, stop, self._END)
+        except BaseException as e:
+            self._put(ready, stop, e)
+
+    def __iter__(self):
+        ready = queue.Queue(maxsize=self.size)
+        stop = threading.Event()
+        worker = threading.Thread(target=self._fill, args=(ready, stop), daemon=True)
+        worker.start()
+        try:
+            while True:
+                item = ready.get()
+                if item is self._END:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            # the consumer may stop early; let the worker exit instead of blocking on put
+            stop.set()
+
+def prefetch(batches, size):
+    """batches wrapped in a Prefetcher, or as they are when size <= 0"""
+    if size <= 0:
+        return batches
+    return Prefetcher(batches, size)
 
-        random.shuffle(all_input)
-        new_all = list(zip(*all_input))
-    else:
-        new_all = [emojis, ori_seqs, rep_seqs]
+# for discriminator
+def build_dis_data(human_path, machine_path, word2index, use_cache=True):
+    """[seqs, labels] as a Ragged and an int32 array, cached like build_data"""
+    if not use_cache:
+        return read_dis_data(human_path, machine_path, word2index)
 
-    data_size = len(emojis)
-    num_batches = int((data_size - 1.) / batch_size) + 1
+    def build_arrays():
+        seqs, labels = read_dis_data(human_path, machine_path, word2index)
+        return {"tokens": seqs.tokens, "offsets": seqs.offsets, "labels": labels}
 
-    rtn = []
-    for batch_num in range(num_batches):
-        e = min((batch_num + 1) * batch_size, data_size)
-        s = e - batch_size
-        assert(s >= 0)
-        rtn.append(generate_one_batch(new_all, start_i, end_i, s, e))
-    return rtn
+    arrays = cached_corpus(corpus_cache_dir([human_path, machine_path], word2index), build_arrays)
+    return [Ragged(arrays["tokens"], arrays["offsets"]), arrays["labels"]]
 
-# for discriminator
-def build_dis_data(human_path, machine_path, word2index):
+def read_dis_data(human_path, machine_path, word2index):
     unk_i = word2index['<unk>']
 
     with open(human_path, encoding="utf-8") as f:
@@ -167,43 +611,61 @@ def build_dis_data(human_path, machine_path, word2index):
     labels += [1] * (len(seqs)-len(labels))
 
     assert len(labels) == len(seqs)
-    return [seqs, labels]
+    return [Ragged.from_seqs(seqs), np.array(labels, dtype=np.int32)]
 
-def generate_dis_batches(data_l, batch_size, permutate):
+def merge_small_tail(bounds, min_batch_size):
+    if len(bounds) > 1 and bounds[-1][1] - bounds[-1][0] < min_batch_size:
+        bounds = bounds[:-2] + [(bounds[-2][0], bounds[-1][1])]
+    return bounds
+
+def generate_dis_batches(data_l, batch_size, permutate, min_batch_size=1):
     seqs = data_l[0]
     labels = data_l[1]
 
     if permutate:
-        all_input = list(zip(seqs, labels))
-
-        random.shuffle(all_input)
-        seqs, labels = list(zip(*all_input))
+        perm = np.random.permutation(len(labels))
+        seqs = as_ragged(seqs).take(perm)
+        labels = np.asarray(labels)[perm]
 
     data_size = len(labels)
-    num_batches = int((data_size - 1.) / batch_size) + 1
 
+    bounds = [(s, min(s + batch_size, data_size)) for s in range(0, data_size, batch_size)]
     batches = []
-    for batch_num in range(num_batches):
-        e = min((batch_num + 1) * batch_size, data_size)
-        s = e - batch_size
-        assert (s >= 0)
-
+    for s, e in merge_small_tail(bounds, min_batch_size):
         labels_vec = np.array(labels[s:e], dtype=np.int32)
 
-        text_lengths = np.array([len(seq) for seq in seqs[s:e]])
-        max_text_len = np.max(text_lengths)
+        text_seqs = as_ragged(seqs[s:e])
+        text_lengths = text_seqs.lengths
         min_text_len = np.min(text_lengths)
         assert (min_text_len > 0)
-        text_matrix = np.zeros([max_text_len, batch_size], dtype=np.int32)
-
-        for i, seq in enumerate(seqs[s:e]):
-            for j, elem in enumerate(seq):
-                text_matrix[j, i] = elem
+        text_matrix = pack_time_major(text_seqs)
 
         one_batch = [text_matrix, text_lengths, labels_vec]
         batches.append(one_batch)
     return batches
 
+"""generation post-processing"""
+def sequence_lengths(ids, end_i):
+    """lengths of the time-major sequences in ids [len, batch_size], each cut before its first end_i"""
+    is_end = ids == end_i
+    return np.where(is_end.any(axis=0), is_end.argmax(axis=0), ids.shape[0])
+
+def truncate_generations(ids, end_i):
+    """the sequences of ids [len, batch_size] up to their first end_i, as lists of ids"""
+    lengths = sequence_lengths(ids, end_i)
+    return [list(ids[:length, i]) for i, length in enumerate(lengths)]
+
+def vocab_array(index2word):
+    """index2word as an object array, so that a whole sequence of ids is looked up at once"""
+    return np.array([index2word[index] for index in range(len(index2word))], dtype=object)
+
+def detokenize(seqs, vocab):
+    """one line per sequence: every word followed by a space, as run.py has always written them"""
+    seqs = as_ragged(seqs)
+    words = vocab[seqs.flat_tokens] + " "
+    offsets = seqs.offsets - seqs.offsets[0]
+    return ["".join(words[offsets[i]:offsets[i + 1]]) + "\n" for i in range(len(seqs))]
+
 """utils"""
 def safe_exp(value):
   """Exponentiation with catching of overflow error."""
@@ -0,0 +1,157 @@
+"""load generator for serve.py: replays original tweets of a data set as concurrent requests
+
+usage: python loadgen.py --ori tiny_input/test.ori [--url http://127.0.0.1:8000] [--requests 1000] [--concurrency 32]
+
+e.g. against the tiny model:
+    python run.py --input_dir tiny_input --param_set tiny ...
+    python serve.py --input_dir tiny_input --run_dir <run dir> --param_set tiny &
+    python loadgen.py --ori tiny_input/test.ori
+
+or as a self-contained check of serve.py and this client, which saves an untrained
+tiny model as a run's checkpoint, serves it on a free port and fails on any unanswered request:
+    python loadgen.py --check [--input_dir tiny_input]
+"""
+import argparse
+import importlib
+import json
+import tempfile
+import threading
+from itertools import cycle, islice
+from os.path import join
+from time import time
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import numpy as np
+import tensorflow as tf
+
+from cvae import CVAE
+from helpers import build_vocab, print_out
+from model_helpers import session_config
+from serve import Generator, LatencyStats, MicroBatcher, Server, make_handler
+
+
+def read_requests(ori_path):
+    """(emoji, tweet) pairs of the lines of a .ori file, "emoji word word ..." """
+    with open(ori_path, encoding="utf-8") as f:
+        words_l = [line.split() for line in f]
+    return [(words[0], " ".join(words[1:])) for words in words_l if words]
+
+
+def post(url, emoji, tweet):
+    body = json.dumps({"emoji": emoji, "tweet": tweet}).encode("utf-8")
+    request = Request(url + "/generate", data=body, headers={"Content-Type": "application/json"})
+    with urlopen(request) as response:
+        return json.loads(response.read().decode("utf-8"))["response"]
+
+
+def run_load(url, requests, concurrency):
+    """sends requests from concurrency threads, returns (latencies in seconds of the answered ones,
+    number of failed ones, wall time)"""
+    todo = iter(enumerate(requests))
+    lock = threading.Lock()
+    latencies = [None] * len(requests)
+
+    def work():
+        while True:
+            with lock:
+                job = next(todo, None)
+            if job is None:
+                return
+            i, (emoji, tweet) = job
+            start = time()
+            try:
+                post(url, emoji, tweet)
+            except OSError:  # counted as failed
+                continue
+            latencies[i] = time() - start
+
+    start = time()
+    threads = [threading.Thread(target=work) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_time = time() - start
+    answered = [latency for latency in latencies if latency is not None]
+    return np.array(answered), len(requests) - len(answered), wall_time
+
+
+def report(latencies, failed, wall_time):
+    if not len(latencies):
+        print_out("client:\t0 answered\t%d failed" % failed)
+        return
+    latencies = latencies * 1000
+    print_out("client:\t%d answered\t%d failed\tp50 %.1f ms\tp99 %.1f ms\t%.1f requests/s" % (
+        len(latencies), failed, np.percentile(latencies, 50), np.percentile(latencies, 99),
+        len(latencies) / wall_time))
+
+
+def check_tiny_model(input_dir, num_requests=64, concurrency=8):
+    """restores a freshly initialized tiny CVAE from a checkpoint laid out like run.py's, serves it
+    and drives the tweets of test.ori against it: every request must be answered"""
+    params = importlib.import_module("params.tiny")
+    word2index, _ = build_vocab(join(input_dir, "vocab.ori"))
+    run_dir = tempfile.mkdtemp()
+    with tf.Graph().as_default():
+        CVAE(len(word2index), params.embed_size, params.num_unit, params.latent_dim, params.emoji_dim,
+             params.batch_size, 1., 1., params.decoder_layer, word2index['<s>'], word2index['</s>'],
+             params.beam_width, params.maximum_iterations, params.max_gradient_norm, params.lr, params.dropout,
+             params.num_gpu, params.cell_type, False, device_type=params.device_type,
+             fused_encoder=params.fused_encoder, optimizer=params.optimizer,
+             mu_update_interval=params.mu_update_interval, decode_length_ratio=params.decode_length_ratio)
+        with tf.Session(config=session_config(
+                params.device_type, params.num_gpu, params.intra_op_threads, params.inter_op_threads)) as sess:
+            sess.run(tf.global_variables_initializer())
+            tf.train.Saver().save(sess, join(run_dir, "breakpoints/best_test_bleu.ckpt"))
+
+    generator = Generator(params, input_dir, run_dir)
+    stats = LatencyStats()
+    batcher = MicroBatcher(generator, params.batch_size, 0.01, stats)
+    server = Server(("127.0.0.1", 0), make_handler(batcher, stats))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:%d" % server.server_address[1]
+    try:
+        requests = list(islice(cycle(read_requests(join(input_dir, "test.ori"))), num_requests))
+        assert isinstance(post(url, *requests[0]), str)
+        latencies, failed, wall_time = run_load(url, requests, concurrency)
+        report(latencies, failed, wall_time)
+        assert failed == 0 and len(latencies) == num_requests, "%d of %d requests failed" % (failed, num_requests)
+        with urlopen(url + "/stats") as response:
+            server_stats = json.loads(response.read().decode("utf-8"))
+        assert server_stats["requests"] == num_requests + 1 and server_stats["mean_batch_size"] >= 1, server_stats
+        # malformed requests are refused before they reach a batch
+        try:
+            post(url, 1, "tweet")
+            assert False, "a non-string emoji was served"
+        except HTTPError as e:
+            assert e.code == 400, e.code
+    finally:
+        server.shutdown()
+        server.server_close()
+    print_out("check passed")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ori", type=str, help="""\
+        .ori file whose tweets are sent, repeated up to --requests""")
+    parser.add_argument("--check", action="store_true", help="""\
+        serve an untrained tiny model from --input_dir and check that every request is answered""")
+    parser.add_argument("--input_dir", type=str, default="tiny_input", help="""\
+        data directory of --check, holding vocab.ori and test.ori""")
+    parser.add_argument("--url", type=str, default="http://127.0.0.1:8000")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    FLAGS, _ = parser.parse_known_args()
+
+    if FLAGS.check:
+        check_tiny_model(FLAGS.input_dir)
+        exit()
+    if FLAGS.ori is None:
+        parser.error("--ori is required unless --check")
+
+    requests = list(islice(cycle(read_requests(FLAGS.ori)), FLAGS.requests))
+    report(*run_load(FLAGS.url, requests, FLAGS.concurrency))
+    with urlopen(FLAGS.url + "/stats") as response:
+        print_out("server:\t%s" % response.read().decode("utf-8"))
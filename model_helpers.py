@@ -1,15 +1,24 @@
 import tensorflow as tf
+import os
+from contextlib import contextmanager
+
+from yellowfin import YFOptimizer
 
 xavier = tf.contrib.layers.xavier_initializer()
 
 def build_bidirectional_rnn(
-        num_dim, inputs, sequence_length, cell_type, num_gpu, base_gpu=0, drop=None, dtype=tf.float32):
+        num_dim, inputs, sequence_length, cell_type, num_gpu, base_gpu=0, drop=None, dtype=tf.float32,
+        device_type="gpu", fused=False):
     # TODO: move rnn cell creation functions to a separate file
+    if fused:
+        return build_fused_bidirectional_rnn(
+            num_dim, inputs, sequence_length, num_gpu, base_gpu, drop, dtype, device_type)
+
     # Construct forward and backward cells
     fw_cell = create_rnn_cell(
-        num_dim, base_gpu, cell_type, num_gpu, drop)
+        num_dim, base_gpu, cell_type, num_gpu, drop, device_type)
     bw_cell = create_rnn_cell(
-        num_dim, (base_gpu + 1), cell_type, num_gpu, drop)
+        num_dim, (base_gpu + 1), cell_type, num_gpu, drop, device_type)
 
     bi_output, bi_state = tf.nn.bidirectional_dynamic_rnn(
         fw_cell,
@@ -22,16 +31,204 @@ def build_bidirectional_rnn(
     return bi_output, bi_state
 
 
-def create_rnn_cell(num_dim, base_gpu, cell_type, num_gpu, drop=None):
+def build_fused_bidirectional_rnn(
+        num_dim, inputs, sequence_length, num_gpu, base_gpu=0, drop=None, dtype=tf.float32, device_type="gpu"):
+    """bidirectional LSTM, each direction one fused kernel over the whole time-major sequence
+
+    Instead of a handful of ops per time step, so much cheaper on CPU. Only the h
+    part of the final LSTM states is returned: the states have a single tensor
+    per direction, like those of the GRU encoders. Its variables don't match the
+    ones of a cell_type encoder.
+    """
+    if drop:
+        inputs = tf.nn.dropout(inputs, 1.0 - drop)
+
+    with tf.variable_scope("bidirectional_rnn"):
+        with rnn_device(base_gpu, num_gpu, device_type):
+            fw_cell = tf.contrib.rnn.LSTMBlockFusedCell(num_dim, name="fw")
+            fw_output, fw_state = fw_cell(inputs, dtype=dtype, sequence_length=sequence_length)
+        with rnn_device(base_gpu + 1, num_gpu, device_type):
+            bw_cell = tf.contrib.rnn.TimeReversedFusedRNN(tf.contrib.rnn.LSTMBlockFusedCell(num_dim, name="bw"))
+            bw_output, bw_state = bw_cell(inputs, dtype=dtype, sequence_length=sequence_length)
+
+    return (fw_output, bw_output), (fw_state.h, bw_state.h)
+
+
+@contextmanager
+def rnn_device(base_gpu, num_gpu, device_type):
+    """the placement create_rnn_cell gives a cell, none when num_gpu is 0"""
+    if num_gpu > 0:
+        with tf.device("/%s:%d" % (device_type, base_gpu % num_gpu)):
+            yield
+    else:
+        yield
+
+
+def create_rnn_cell(num_dim, base_gpu, cell_type, num_gpu, drop=None, device_type="gpu"):
     # dropout = dropout if mode == tf.contrib.learn.ModeKeys.TRAIN else 0.0
-    device_str = "/gpu:%d" % (base_gpu % num_gpu)
-    print(device_str)
     single_cell = cell_type(num_dim)
-    single_cell = tf.contrib.rnn.DeviceWrapper(single_cell, device_str)
+    if num_gpu > 0:  # cells alternate over num_gpu devices of device_type, 0 leaves placement to TF
+        device_str = "/%s:%d" % (device_type, base_gpu % num_gpu)
+        single_cell = tf.contrib.rnn.DeviceWrapper(single_cell, device_str)
     if drop:
         single_cell = tf.contrib.rnn.DropoutWrapper(cell=single_cell, input_keep_prob=(1.0 - drop))
     return single_cell
 
+
+"""execution profile"""
+def add_profile_arguments(parser):
+    """CLI overrides of the execution profile set in the params"""
+    parser.add_argument("--device_type", type=str, default=None, help="""\
+        gpu/cpu""")
+    parser.add_argument("--num_device", type=int, default=None, help="""\
+        number of devices the rnn cells alternate over, 0 leaves placement to TF""")
+    parser.add_argument("--intra_op_threads", type=int, default=None, help="""\
+        threads of a single op (matmuls), 0 lets TF pick""")
+    parser.add_argument("--inter_op_threads", type=int, default=None, help="""\
+        ops run concurrently, 0 lets TF pick""")
+
+
+def resolve_profile(FLAGS, device_type, num_device, intra_op_threads, inter_op_threads):
+    """(device_type, num_device, intra_op_threads, inter_op_threads) from the params, overridden by set flags"""
+    profile = (device_type, num_device, intra_op_threads, inter_op_threads)
+    flags = (FLAGS.device_type, FLAGS.num_device, FLAGS.intra_op_threads, FLAGS.inter_op_threads)
+    return tuple(value if flag is None else flag for value, flag in zip(profile, flags))
+
+
+def session_config(device_type="gpu", num_device=1, intra_op_threads=0, inter_op_threads=0):
+    """ConfigProto for an execution profile
+
+    On CPU the host is split into num_device virtual devices, so that "/cpu:i"
+    placements resolve, and all of them share the same thread pools.
+    """
+    config = tf.ConfigProto(
+        allow_soft_placement=True,
+        intra_op_parallelism_threads=intra_op_threads,
+        inter_op_parallelism_threads=inter_op_threads)
+    if device_type == "cpu":
+        config.device_count["CPU"] = max(num_device, 1)
+        config.device_count["GPU"] = 0
+        set_cpu_thread_env(intra_op_threads)
+    else:
+        config.gpu_options.allow_growth = True
+    return config
+
+
+def set_cpu_thread_env(intra_op_threads):
+    # OpenMP/MKL settings Intel recommends for TF on multi-socket hosts: pin the pool compactly to cores
+    # and don't spin between ops. Values already in the environment win.
+    # They only take effect if set before the first op runs.
+    if intra_op_threads > 0:
+        os.environ.setdefault("OMP_NUM_THREADS", str(intra_op_threads))
+    os.environ.setdefault("KMP_BLOCKTIME", "1")
+    os.environ.setdefault("KMP_AFFINITY", "granularity=fine,compact,1,0")
+
+
+"""data-parallel towers"""
+def tower_devices(device_type, num_tower):
+    return ["/%s:%d" % (device_type, i) for i in range(num_tower)]
+
+
+def split_batch(tensors, batch_axes, num_splits):
+    """splits every tensor along its batch axis into num_splits parts of sizes differing by at most one
+
+    Returns one list of tensors per split. All tensors must share the batch size,
+    which has to be at least num_splits: an empty split fails an in-graph assertion
+    rather than building a tower on no examples.
+    """
+    batch_size = tf.shape(tensors[0])[batch_axes[0]]
+    check = tf.assert_greater_equal(
+        batch_size, num_splits, message="batch smaller than the number of towers %d" % num_splits)
+    with tf.control_dependencies([check]):
+        batch_size = tf.identity(batch_size)
+    # (batch_size + i) // num_splits sums to batch_size over i
+    size_splits = tf.stack([(batch_size + i) // num_splits for i in range(num_splits)])
+    splits = [tf.split(tensor, size_splits, axis=axis, num=num_splits)
+              for tensor, axis in zip(tensors, batch_axes)]
+    return [list(parts) for parts in zip(*splits)]
+
+
+def sum_gradients(tower_grads):
+    """sums the per-variable gradients of the towers
+
+    Tower losses are normalized by the size of the whole batch, so the sum is the
+    gradient average weighted by tower sizes. IndexedSlices (embedding lookups)
+    stay sparse, their values and indices are concatenated.
+    """
+    summed = []
+    for grads in zip(*tower_grads):
+        grads = [grad for grad in grads if grad is not None]
+        if not grads:
+            summed.append(None)
+        elif all(isinstance(grad, tf.IndexedSlices) for grad in grads):
+            summed.append(tf.IndexedSlices(
+                tf.concat([grad.values for grad in grads], axis=0),
+                tf.concat([grad.indices for grad in grads], axis=0),
+                grads[0].dense_shape))
+        else:
+            summed.append(tf.add_n([tf.convert_to_tensor(grad) for grad in grads]))
+    return summed
+
+
+def concat_tower_results(results, end_i):
+    """concatenates the towers' time-major sample ids along the batch, shorter ones padded with end_i"""
+    max_time = tf.reduce_max([tf.shape(result)[0] for result in results])
+    padded = []
+    for result in results:
+        paddings = [[0, max_time - tf.shape(result)[0]]] + [[0, 0]] * (result.shape.ndims - 1)
+        padded.append(tf.pad(result, paddings, constant_values=end_i))
+    return tf.concat(padded, axis=1)
+
+
+
+"""frozen graphs"""
+def freeze_graph(sess, output_names, path):
+    """writes the graph pruned to output_names, with the variables folded into constants and no device pins"""
+    graph_def = sess.graph.as_graph_def()
+    for node in graph_def.node:
+        node.device = ""
+    graph_def = tf.graph_util.convert_variables_to_constants(sess, graph_def, output_names)
+    with tf.gfile.GFile(path, "wb") as f:
+        f.write(graph_def.SerializeToString())
+    return graph_def
+
+
+def load_frozen_graph(path):
+    """a new graph holding the one freeze_graph wrote, node names unchanged"""
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(path, "rb") as f:
+        graph_def.ParseFromString(f.read())
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name="")
+    return graph
+
+"""decoding"""
+class LengthLimitedGreedyHelper(tf.contrib.seq2seq.GreedyEmbeddingHelper):
+    """GreedyEmbeddingHelper whose sequences are also finished after limits[i] steps"""
+    def __init__(self, embedding, start_tokens, end_token, limits):
+        super(LengthLimitedGreedyHelper, self).__init__(embedding, start_tokens, end_token)
+        self._limits = tf.convert_to_tensor(limits, dtype=tf.int32, name="limits")
+
+    def next_inputs(self, time, outputs, state, sample_ids, name=None):
+        finished, next_inputs, next_state = super(LengthLimitedGreedyHelper, self).next_inputs(
+            time, outputs, state, sample_ids, name)
+        # sample_ids are the outputs of step time, time + 1 steps are done
+        return tf.logical_or(finished, time + 1 >= self._limits), next_inputs, next_state
+
+"""optimizers"""
+def create_optimizer(name, lr, mu_update_interval=1):
+    """adam; lazy_adam: Adam that updates the moments of only the rows a sparse (embedding) gradient
+    touches, so a step scales with the words of a batch rather than the vocabulary, and reads/writes
+    Adam checkpoints; yellowfin: YFOptimizer starting from lr, retuned every mu_update_interval steps"""
+    if name == "adam":
+        return tf.train.AdamOptimizer(lr)
+    if name == "lazy_adam":
+        return tf.contrib.opt.LazyAdamOptimizer(lr)
+    if name == "yellowfin":
+        return YFOptimizer(learning_rate=lr, mu_update_interval=mu_update_interval)
+    raise ValueError("unknown optimizer %s, expected adam/lazy_adam/yellowfin" % name)
+
 class Embedding(object):
     def __init__(self, vocab_size, embed_size):
         # TODO: init from embedding
@@ -42,3 +239,23 @@ class Embedding(object):
 
     def __call__(self, texts):
         return tf.nn.embedding_lookup(self.coder, texts)
+
+class OutputProjection(tf.layers.Layer):
+    """Dense layer without bias whose kernel is stored as [units, input_dim], the weights layout of
+    tf.nn.sampled_softmax_loss: sampling gathers its rows, so their gradient stays IndexedSlices"""
+    def __init__(self, units, **kwargs):
+        super(OutputProjection, self).__init__(**kwargs)
+        self.units = units
+
+    def build(self, input_shape):
+        input_shape = tf.TensorShape(input_shape)
+        self.kernel = self.add_variable("kernel", [self.units, input_shape[-1].value], dtype=self.dtype)
+        self.built = True
+
+    def call(self, inputs):
+        if inputs.shape.ndims == 2:
+            return tf.matmul(inputs, self.kernel, transpose_b=True)
+        return tf.tensordot(inputs, self.kernel, [[inputs.shape.ndims - 1], [1]])
+
+    def compute_output_shape(self, input_shape):
+        return tf.TensorShape(input_shape)[:-1].concatenate(self.units)
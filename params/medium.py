@@ -12,12 +12,27 @@ emoji_dim = 8
 lr = 1e-3
 max_gradient_norm = 5
 maximum_iterations = 50
+decode_length_ratio = 0.    # > 0: generate at most ceil(ratio * original tweet length) words, capped as above
+                            # (greedy decoding only, needs beam_width = 0)
 beam_width = 0
 dropout = 0.2
 decoder_layer = 1
+num_sampled = 0     # > 0: train with a sampled softmax over this many words
+optimizer = "adam"  # adam/lazy_adam/yellowfin (or run.py --optimizer), lazy_adam updates only the embedding
+                   # rows a batch uses and doesn't decay the moments of the others (not with accum_steps > 1),
+                   # yellowfin tunes lr and momentum itself (lr is where it starts)
+mu_update_interval = 1  # yellowfin retunes lr and momentum every this many steps
 
 # GRUCell won't have multiple kinds of state. Wouldn't have to flatten its state before concatenation
+# tf.contrib.rnn.GRUBlockCellV2 runs each step as one kernel and reads/writes GRUCell checkpoints
 cell_type = tf.nn.rnn_cell.GRUCell
+fused_encoder = False   # encoders as fused LSTM kernels over whole tweets (own variables, not GRU checkpoints)
+
+"""execution profile"""
+device_type = "gpu"     # gpu/cpu, rnn cells alternate over num_gpu devices of this type (0: no placement)
+intra_op_threads = 0    # threads of a single op, 0 lets TF pick
+inter_op_threads = 0    # ops run concurrently, 0 lets TF pick
+num_tower = 1           # > 1: data-parallel replicas on devices 0..num_tower-1, each gets a slice of the batch
 
 """hyper params for running the graph"""
 # num_epoch = 12      #
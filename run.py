@@ -7,7 +7,8 @@ import tensorflow as tf
 
 tf.logging.set_verbosity(tf.logging.DEBUG)
 
-from helpers import build_data, batch_generator, print_out, build_vocab
+from helpers import build_data, batch_generator, print_out, build_vocab, prefetch, vocab_array, detokenize
+from helpers import build_reference_index
 import json
 
 from time import gmtime, strftime
@@ -19,20 +20,20 @@ from math import tanh
 
 import argparse
 from cvae import CVAE
+from model_helpers import add_profile_arguments, resolve_profile, session_config
 
 def put_eval(recon_loss, kl_loss, bow_loss, ppl, bleu_score, precisions_list, name, f):
     print_out("%s: " % name, new_line=False, f=f)
-    format_string = '\trecon/kl/bow-loss/ppl:\t%.3f\t%.3f\t%.3f\t%.3f\tBLEU:' + '\t%.1f' * 5
-    format_tuple = (recon_loss, kl_loss, bow_loss, ppl, bleu_score) + tuple(precisions_list)
+    format_string = '\trecon/kl/bow-loss/ppl:\t%.3f\t%.3f\t%.3f\t%.3f'
+    format_tuple = (recon_loss, kl_loss, bow_loss, ppl)
+    if bleu_score is not None:  # loss-only evaluation
+        format_string += '\tBLEU:' + '\t%.1f' * 5
+        format_tuple += (bleu_score,) + tuple(precisions_list)
     print_out(format_string % format_tuple, f=f)
 
-def write_out(file, corpus):
+def write_out(file, corpus, vocab):
     with open(file, 'w', encoding="utf-8") as f:
-        for seq in corpus:
-            to_write = ''
-            for index in seq:
-                to_write += index2word[index] + ' '
-            f.write(to_write + '\n')
+        f.writelines(detokenize(corpus, vocab))
 
 def save_best(file, best_bleu, best_epoch, best_step):
     best_dict = {"bleu": best_bleu, "epoch": best_epoch, "step": best_step}
@@ -71,6 +72,9 @@ if __name__ == '__main__':
         output batch eval every *test_step*
         output test eval every 10 x *test_step*
         output train eval every epoch""")
+    cvae_parser.add_argument("--gen_every", type=int, default=1, help="""\
+        decode and compute BLEU (and keep the best model) on every *gen_every*-th test eval,
+        the others only compute the teacher-forced losses""")
 
     cvae_parser.add_argument("--input_dir", type=str, required=True, )
     cvae_parser.add_argument("--param_set", type=str, required=True, help="""\
@@ -78,6 +82,22 @@ if __name__ == '__main__':
     cvae_parser.add_argument("--log_fname", type=str, default="log")
     cvae_parser.add_argument("--is_seq2seq", action="store_true", help="""\
             CVAE model or vanilla seq2seq with similar settings""")
+    cvae_parser.add_argument("--bucket_chunk", type=int, default=0, help="""\
+            sort training examples by length within shuffled chunks of *bucket_chunk* batches
+            to cut padding; 0 keeps plain random batches""")
+    cvae_parser.add_argument("--prefetch", type=int, default=8, help="""\
+            number of training batches built ahead by a background thread; 0 disables it""")
+    cvae_parser.add_argument("--ingest_workers", type=int, default=1, help="""\
+            processes that tokenize the training corpus when its cache has to be (re)built""")
+    cvae_parser.add_argument("--num_tower", type=int, default=None, help="""\
+            data-parallel replicas the batches are split over, overrides num_tower of the params""")
+    cvae_parser.add_argument("--accum_steps", type=int, default=1, help="""\
+            accumulate gradients over *accum_steps* micro-batches of batch_size per update,
+            i.e. train on batches of accum_steps x batch_size with the memory of one""")
+    cvae_parser.add_argument("--optimizer", type=str, default=None, help="""\
+            adam/lazy_adam/yellowfin, overrides optimizer of the params""")
+
+    add_profile_arguments(cvae_parser)
 
     FLAGS, _ = cvae_parser.parse_known_args()
 
@@ -87,6 +107,12 @@ if __name__ == '__main__':
         from params.full import *
     elif FLAGS.param_set == "medium":
         from params.medium import *
+    device_type, num_gpu, intra_op_threads, inter_op_threads = resolve_profile(
+        FLAGS, device_type, num_gpu, intra_op_threads, inter_op_threads)
+    if FLAGS.num_tower is not None:
+        num_tower = FLAGS.num_tower
+    if FLAGS.optimizer is not None:
+        optimizer = FLAGS.optimizer
 
     output_dir_name = strftime("%m-%d_%H-%M-%S", gmtime())
 
@@ -114,6 +140,7 @@ if __name__ == '__main__':
 
     # build vocab
     word2index, index2word = build_vocab(join(input_dir, vocab_f))
+    vocab = vocab_array(index2word)
     start_i, end_i = word2index['<s>'], word2index['</s>']
     vocab_size = len(word2index)
 
@@ -121,25 +148,39 @@ if __name__ == '__main__':
     cvae = CVAE(vocab_size, embed_size, num_unit, latent_dim, emoji_dim, batch_size,
                 FLAGS.kl_ceiling, FLAGS.bow_ceiling, decoder_layer,
                 start_i, end_i, beam_width, maximum_iterations, max_gradient_norm, lr, dropout, num_gpu, cell_type,
-                FLAGS.is_seq2seq)
+                FLAGS.is_seq2seq, num_sampled=num_sampled, device_type=device_type, num_tower=num_tower,
+                fused_encoder=fused_encoder, accum_steps=FLAGS.accum_steps, optimizer=optimizer,
+                mu_update_interval=mu_update_interval, decode_length_ratio=decode_length_ratio)
 
     # building data
-    train_data = build_data(train_ori_f, train_rep_f, word2index)
+    train_data = build_data(train_ori_f, train_rep_f, word2index, num_workers=FLAGS.ingest_workers)
 
     test_data = build_data(test_ori_f, test_rep_f, word2index)
     test_batches = batch_generator(
-        test_data, start_i, end_i, batch_size, permutate=False)
+        test_data, start_i, end_i, batch_size, permutate=False, min_batch_size=num_tower)
+    # n-grams of the test responses, extracted once for the BLEU of every evaluation
+    test_reference_index = build_reference_index(test_ori_f, test_rep_f, test_data[2], word2index)
+
+    # examples per optimizer step, global_step (and so the KL annealing) counts these updates
+    update_size = batch_size * FLAGS.accum_steps
 
     print_out("*** DATA READY ***")
+    if FLAGS.bucket_chunk > 0:
+        print_out("padding ratio:\trandom\t%.3f\tbucketed\t%.3f" % (
+            batch_generator(train_data, start_i, end_i, update_size, lazy=True).padding_ratio(),
+            batch_generator(train_data, start_i, end_i, update_size, lazy=True,
+                            bucket_chunk=FLAGS.bucket_chunk).padding_ratio()))
 
     saver = tf.train.Saver()
-    with tf.Session() as sess:
-        total_step = (FLAGS.num_epoch * len(train_data[0]) / batch_size)
+    num_device = max(num_gpu, num_tower)
+    with tf.Session(config=session_config(device_type, num_device, intra_op_threads, inter_op_threads)) as sess:
+        total_step = (FLAGS.num_epoch * len(train_data[0]) / update_size)
 
         best_f = join(output_dir, "best_bleu.txt")
         global_step = best_step = 1
         start_epoch = best_epoch = 1
         best_bleu = 0.
+        num_test_eval = 0
 
         if FLAGS.init_from_dir == "":
             sess.run(tf.global_variables_initializer())
@@ -147,16 +188,18 @@ if __name__ == '__main__':
             recover_dir = join(input_dir, FLAGS.init_from_dir)
             best_dir = join(recover_dir, "breakpoints/best_test_bleu.ckpt")
             saver.restore(sess, best_dir)
+        sess.run(tf.local_variables_initializer())  # gradient accumulators
 
         # generate_graph()
         for epoch in range(start_epoch, FLAGS.num_epoch + 1):
             train_batches = batch_generator(
-                train_data, start_i, end_i, batch_size)
+                train_data, start_i, end_i, update_size, lazy=True, bucket_chunk=FLAGS.bucket_chunk,
+                min_batch_size=num_tower * FLAGS.accum_steps)
 
             recon_l = []
             kl_l = []
             bow_l = []
-            for batch in train_batches:
+            for batch in prefetch(train_batches, FLAGS.prefetch):
                 """ TRAIN """
                 kl_weight = get_kl_weight(global_step, total_step, FLAGS.anneal_ratio)
                 recon_loss, kl_loss, bow_loss = cvae.train_update(batch, sess, kl_weight)
@@ -173,17 +216,21 @@ if __name__ == '__main__':
                     bow_l = []
                 if global_step % (FLAGS.test_step * 10) == 0:
                     """ EVAL and INFER """
+                    num_test_eval += 1
+                    generate = num_test_eval % FLAGS.gen_every == 0
 
                     # TEST
                     (test_recon_loss, test_kl_loss, test_bow_loss,
-                     perplexity, test_bleu_score, precisions, _) = cvae.infer_and_eval(test_batches, sess)
+                     perplexity, test_bleu_score, precisions, _) = cvae.infer_and_eval(
+                        test_batches, sess, mode="both" if generate else "loss",
+                        reference_index=test_reference_index)
                     print_out("EPOCH:\t%d\tSTEP:\t%d\t" % (epoch, global_step), new_line=False, f=log_f)
                     put_eval(
                         test_recon_loss, test_kl_loss, test_bow_loss,
                         perplexity, test_bleu_score, precisions, "TEST", log_f)
 
                     # get down best
-                    if test_bleu_score >= best_bleu and kl_weight == 1.:
+                    if generate and test_bleu_score >= best_bleu and kl_weight == 1.:
                         best_bleu = test_bleu_score
                     # if train_bleu_score >= best_bleu:  # TODO: train or test?
                     #     best_bleu = train_bleu_score
@@ -197,8 +244,12 @@ if __name__ == '__main__':
                 global_step += 1
 
             # TRAIN
+            if FLAGS.accum_steps > 1:  # evaluate in batches that fit, not whole updates
+                train_batches = batch_generator(
+                    train_data, start_i, end_i, batch_size, permutate=False, lazy=True, min_batch_size=num_tower)
             (train_recon_loss, train_kl_loss, train_bow_loss,
-             perplexity, train_bleu_score, precisions, _) = cvae.infer_and_eval(train_batches, sess)
+             perplexity, train_bleu_score, precisions, _) = cvae.infer_and_eval(
+                prefetch(train_batches, FLAGS.prefetch), sess)
             print_out("EPOCH:\t%d\tSTEP:\t%d\t" % (epoch, global_step), new_line=False, f=log_f)
             put_eval(
                 train_recon_loss, train_kl_loss, train_bow_loss,
@@ -211,14 +262,18 @@ if __name__ == '__main__':
         """GENERATE"""
         # TRAIN SET
         train_batches = batch_generator(
-            train_data, start_i, end_i, batch_size, permutate=False)
+            train_data, start_i, end_i, batch_size, permutate=False, lazy=True, min_batch_size=num_tower)
         (train_recon_loss, train_kl_loss, train_bow_loss,
-         perplexity, train_bleu_score, precisions, generation_corpus) = cvae.infer_and_eval(train_batches, sess)
-        write_out(train_out_f, generation_corpus)
+         perplexity, train_bleu_score, precisions, generation_corpus) = cvae.infer_and_eval(
+            prefetch(train_batches, FLAGS.prefetch), sess, mode="generate", keep_corpus=True)
+        write_out(train_out_f, generation_corpus, vocab)
         print_out("BEST TRAIN BLEU: %.1f" % train_bleu_score, f=log_f)
 
         # TEST SET
-        generation_corpus = cvae.infer_and_eval(test_batches, sess)[-1]
-        write_out(test_out_f, generation_corpus)
+        generation_corpus = cvae.infer_and_eval(
+            test_batches, sess, mode="generate", keep_corpus=True, reference_index=test_reference_index)[-1]
+        write_out(test_out_f, generation_corpus, vocab)
+        # compare with a decode_length_ratio = 0 run (or benchmark.py decode) for what the budget saves
+        print_out("TEST DECODE STEPS: %d" % cvae.decode_steps, f=log_f)
 
     log_f.close()
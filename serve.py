@@ -0,0 +1,235 @@
+"""HTTP server generating emoji-conditioned responses with a trained CVAE
+
+usage: python serve.py --input_dir <data dir> --run_dir <output dir of run.py> --param_set tiny
+                       [--port 8000] [--max_batch 64] [--max_wait_ms 10]
+
+    POST /generate  {"emoji": "😂", "tweet": "words of the original tweet"}  ->  {"response": "..."}
+    GET  /stats     ->  requests served, p50/p99 latency (ms) and throughput (requests/s)
+
+Requests are collected into micro-batches: a batch runs as soon as it holds
+max_batch requests or its first request has waited max_wait_ms.
+"""
+import argparse
+import importlib
+import json
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import join
+from time import time
+
+import numpy as np
+import tensorflow as tf
+
+from cvae import CVAE
+from helpers import build_vocab, pack_time_major, print_out, as_ragged, sequence_lengths, vocab_array
+from model_helpers import session_config
+
+
+class MicroBatcher(object):
+    """Runs items submitted from many threads in batches on a single worker thread.
+
+    run_batch maps a list of items to a list of results, submit returns a
+    Future of one item's result. A batch that fails is rerun item by item, so
+    only the items that fail alone get the exception. With stats, the size of
+    every batch is recorded.
+    """
+    def __init__(self, run_batch, max_batch, max_wait, stats=None):
+        self.run_batch = run_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.stats = stats
+        self.pending = queue.Queue()
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def submit(self, item):
+        future = Future()
+        self.pending.put((item, future))
+        return future
+
+    def _next_batch(self):
+        batch = [self.pending.get()]
+        deadline = time() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.pending.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _serve(self):
+        while True:
+            batch = self._next_batch()
+            items, futures = zip(*batch)
+            if self.stats is not None:
+                self.stats.record_batch(len(items))
+            try:
+                results = self.run_batch(list(items))
+            except Exception as e:
+                if len(items) == 1:
+                    futures[0].set_exception(e)
+                else:  # only the items at fault fail
+                    for item, future in zip(items, futures):
+                        self._run_one(item, future)
+                continue
+            for future, result in zip(futures, results):
+                future.set_result(result)
+
+    def _run_one(self, item, future):
+        try:
+            future.set_result(self.run_batch([item])[0])
+        except Exception as e:
+            future.set_exception(e)
+
+
+class LatencyStats(object):
+    """latency percentiles over the last window requests, throughput since the first one"""
+    def __init__(self, window=10000):
+        self.latencies = deque(maxlen=window)
+        self.count = 0
+        self.batch_sizes = deque(maxlen=window)
+        self.start = None
+        self.lock = threading.Lock()
+
+    def record(self, latency):
+        with self.lock:
+            if self.start is None:
+                self.start = time() - latency
+            self.latencies.append(latency)
+            self.count += 1
+
+    def record_batch(self, batch_size):
+        with self.lock:
+            self.batch_sizes.append(batch_size)
+
+    def snapshot(self):
+        with self.lock:
+            if not self.count:
+                return {"requests": 0}
+            latencies = np.array(self.latencies) * 1000
+            return {
+                "requests": self.count,
+                "p50_ms": float(np.percentile(latencies, 50)),
+                "p99_ms": float(np.percentile(latencies, 99)),
+                "throughput": self.count / (time() - self.start),
+                "mean_batch_size": float(np.mean(self.batch_sizes)),
+            }
+
+
+class Generator(object):
+    """restores the inference graph from a training checkpoint once and generates for lists of requests"""
+    def __init__(self, params, input_dir, run_dir, is_seq2seq=False):
+        self.word2index, index2word = build_vocab(join(input_dir, "vocab.ori"))
+        self.vocab = vocab_array(index2word)
+        self.unk_i = self.word2index['<unk>']
+        self.end_i = self.word2index['</s>']
+
+        graph = tf.Graph()
+        with graph.as_default():
+            self.cvae = CVAE(len(self.word2index), params.embed_size, params.num_unit, params.latent_dim,
+                             params.emoji_dim, params.batch_size, 1., 1., params.decoder_layer,
+                             self.word2index['<s>'], self.end_i, params.beam_width, params.maximum_iterations,
+                             params.max_gradient_norm, params.lr, params.dropout, params.num_gpu,
+                             params.cell_type, is_seq2seq, device_type=params.device_type,
+                             fused_encoder=params.fused_encoder,
+                             decode_length_ratio=params.decode_length_ratio, infer_only=True)
+            saver = tf.train.Saver()
+        self.sess = tf.Session(graph=graph, config=session_config(
+            params.device_type, params.num_gpu, params.intra_op_threads, params.inter_op_threads))
+        saver.restore(self.sess, join(run_dir, "breakpoints/best_test_bleu.ckpt"))
+
+    def __call__(self, requests):
+        """requests: [(emoji, tweet)] strings, returns the response strings"""
+        emojis = np.array([self.word2index.get(emoji, self.unk_i) for emoji, _ in requests], dtype=np.int32)
+        # an empty tweet still needs one step for the encoders
+        ori_seqs = as_ragged([[self.word2index.get(word, self.unk_i) for word in tweet.split()] or [self.unk_i]
+                              for _, tweet in requests])
+        result = self.sess.run(self.cvae.result, feed_dict={
+            self.cvae.emoji: emojis,
+            self.cvae.ori: pack_time_major(ori_seqs),
+            self.cvae.ori_len: ori_seqs.lengths})
+        if result.ndim == 3:  # beam search, best beam first
+            result = result[:, :, 0]
+
+        lengths = sequence_lengths(result, self.end_i)
+        return [" ".join(self.vocab[result[:length, i]]) for i, length in enumerate(lengths)]
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # the default backlog of 5 resets connections of concurrent clients
+
+
+def make_handler(batcher, stats):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != "/generate":
+                return self.send_error(404)
+            start = time()
+            try:
+                request = json.loads(self.rfile.read(int(self.headers["Content-Length"])).decode("utf-8"))
+                item = (request["emoji"], request["tweet"])
+                if not all(isinstance(field, str) for field in item):
+                    raise TypeError
+            except (ValueError, KeyError, TypeError):
+                return self.send_error(400, "expected {\"emoji\": \"...\", \"tweet\": \"...\"} strings")
+            try:
+                response = batcher.submit(item).result()
+            except Exception as e:
+                return self.send_error(500, str(e))
+            stats.record(time() - start)
+            self.reply({"response": response})
+
+        def do_GET(self):
+            if self.path != "/stats":
+                return self.send_error(404)
+            self.reply(stats.snapshot())
+
+        def reply(self, obj):
+            body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):  # one line per request would dominate the output
+            pass
+    return Handler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_dir", type=str, required=True, help="""\
+        data directory holding vocab.ori""")
+    parser.add_argument("--run_dir", type=str, required=True, help="""\
+        output directory of the training run, relative to input_dir""")
+    parser.add_argument("--param_set", type=str, required=True, help="""\
+        tiny/medium/full, the one the run was trained with""")
+    parser.add_argument("--is_seq2seq", action="store_true")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max_batch", type=int, default=64, help="""\
+        most requests decoded together""")
+    parser.add_argument("--max_wait_ms", type=float, default=10., help="""\
+        latency budget: how long the first request of a batch waits for others""")
+    FLAGS, _ = parser.parse_known_args()
+
+    params = importlib.import_module("params.%s" % FLAGS.param_set)
+    generator = Generator(params, FLAGS.input_dir, join(FLAGS.input_dir, FLAGS.run_dir), FLAGS.is_seq2seq)
+    stats = LatencyStats()
+
+    batcher = MicroBatcher(generator, FLAGS.max_batch, FLAGS.max_wait_ms / 1000., stats)
+    server = Server((FLAGS.host, FLAGS.port), make_handler(batcher, stats))
+    print_out("*** SERVING on %s:%d ***" % (FLAGS.host, FLAGS.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print_out(json.dumps(stats.snapshot()))
@@ -0,0 +1,5 @@
+import sys
+from os.path import abspath, dirname
+
+# the modules live at the top of the repository, next to run.py
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+from bleu import BleuAccumulator, ReferenceIndex, compute_bleu, compute_bleu_fast
+
+
+def random_corpora(num_trials=200, seed=0):
+    # small vocabularies for many matches
+    rng = np.random.RandomState(seed)
+    for _ in range(num_trials):
+        vocab_size = rng.randint(2, 30)
+        num_sentence = rng.randint(1, 50)
+        translations = [list(rng.randint(vocab_size, size=rng.randint(0, 12))) for _ in range(num_sentence)]
+        references = [[list(rng.randint(vocab_size, size=rng.randint(1, 12))) for _ in range(rng.randint(1, 4))]
+                      for _ in range(num_sentence)]
+        yield references, translations
+
+
+@pytest.mark.parametrize("max_order", [1, 2, 4])
+@pytest.mark.parametrize("smooth", [False, True])
+def test_fast_bleu_matches_compute_bleu(max_order, smooth):
+    for references, translations in random_corpora():
+        expected = compute_bleu(references, translations, max_order, smooth)
+        assert compute_bleu_fast(references, translations, max_order, smooth) == expected
+
+        accumulator = BleuAccumulator(max_order, smooth)
+        for i in range(0, len(translations), 7):
+            accumulator.add(references[i:i + 7], translations[i:i + 7])
+        assert accumulator.result() == expected
+
+        # through the cached arrays, as helpers.build_reference_index reloads it
+        index = ReferenceIndex.from_arrays(ReferenceIndex.build(references, max_order).arrays())
+        accumulator = BleuAccumulator(max_order, smooth)
+        for i in range(0, len(translations), 7):
+            accumulator.add_indexed(index, translations[i:i + 7], i)
+        assert accumulator.result() == expected
@@ -0,0 +1,79 @@
+import shutil
+from os.path import abspath, dirname, join
+
+import numpy as np
+import pytest
+
+pytest.importorskip("tensorflow")
+
+import helpers
+from helpers import build_data, build_reference_index, build_vocab, read_data, read_data_parallel
+
+TINY_INPUT = join(dirname(dirname(abspath(__file__))), "tiny_input")
+
+
+def assert_same_data(a, b):
+    assert np.array_equal(a[0], b[0])
+    for x, y in zip(a[1:], b[1:]):
+        assert np.array_equal(x.lengths, y.lengths) and np.array_equal(x.flat_tokens, y.flat_tokens)
+
+
+@pytest.fixture
+def word2index():
+    return build_vocab(join(TINY_INPUT, "vocab.ori"))[0]
+
+
+@pytest.fixture
+def small_blocks(monkeypatch):
+    # blocks small enough to split "\r\n" line ends, the forked workers inherit it
+    monkeypatch.setattr(helpers, "INGEST_BLOCK_SIZE", 7)
+
+
+@pytest.mark.parametrize("num_workers", [2, 3])
+def test_read_data_parallel_on_tiny_input(word2index, num_workers):
+    ori_path, rep_path = join(TINY_INPUT, "train.ori"), join(TINY_INPUT, "train.rep")
+    assert_same_data(read_data_parallel(ori_path, rep_path, word2index, num_workers),
+                     read_data(ori_path, rep_path, word2index))
+
+
+@pytest.mark.parametrize("num_workers", [1, 2, 5])
+def test_read_data_parallel_on_mixed_line_ends(tmpdir, word2index, small_blocks, num_workers):
+    words = sorted(word2index)
+    rng = np.random.RandomState(0)
+    for name in ("ori", "rep"):
+        lines = [" ".join(rng.choice(words, rng.randint(1, 8))) for _ in range(500)]
+        ends = rng.choice(["\n", "\r\n", "\r"], len(lines), p=[.6, .2, .2])
+        with open(str(tmpdir.join(name)), "w", encoding="utf-8", newline="") as f:
+            f.write("".join(line + end for line, end in zip(lines, ends)))
+    ori_path, rep_path = str(tmpdir.join("ori")), str(tmpdir.join("rep"))
+    assert_same_data(read_data_parallel(ori_path, rep_path, word2index, num_workers),
+                     read_data(ori_path, rep_path, word2index))
+
+
+def test_reference_index_cache_follows_the_original_tweets(tmpdir, word2index):
+    ori_path, rep_path = str(tmpdir.join("test.ori")), str(tmpdir.join("test.rep"))
+    shutil.copy(join(TINY_INPUT, "train.ori"), ori_path)
+    shutil.copy(join(TINY_INPUT, "train.rep"), rep_path)
+    rep_seqs = build_data(ori_path, rep_path, word2index)[2]
+    assert len(build_reference_index(ori_path, rep_path, rep_seqs, word2index)) == len(rep_seqs)
+
+    # an original tweet too short to keep drops its pair, the response file is unchanged
+    with open(ori_path, encoding="utf-8") as f:
+        lines = f.readlines()
+    lines[0] = lines[0].split()[0] + "\n"
+    with open(ori_path, "w", encoding="utf-8") as f:
+        f.writelines(lines)
+    shorter_rep_seqs = build_data(ori_path, rep_path, word2index)[2]
+    assert len(shorter_rep_seqs) == len(rep_seqs) - 1
+    assert len(build_reference_index(ori_path, rep_path, shorter_rep_seqs, word2index)) == len(shorter_rep_seqs)
+
+
+def test_build_data_without_a_writable_cache(tmpdir, word2index):
+    ori_path, rep_path = str(tmpdir.join("train.ori")), str(tmpdir.join("train.rep"))
+    shutil.copy(join(TINY_INPUT, "train.ori"), ori_path)
+    shutil.copy(join(TINY_INPUT, "train.rep"), rep_path)
+    # a file in the way of the cache directory fails its writes, as a read-only directory would
+    tmpdir.join(helpers.CACHE_DIR_NAME).write("")
+    assert_same_data(build_data(ori_path, rep_path, word2index), read_data(ori_path, rep_path, word2index))
+    rep_seqs = build_data(ori_path, rep_path, word2index)[2]
+    assert len(build_reference_index(ori_path, rep_path, rep_seqs, word2index)) == len(rep_seqs)
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+
+from yellowfin import get_cubic_root
+
+
+def test_cubic_root_matches_np_roots():
+    # the root in [0, 1] of -x**3 + 3x**2 - (3 + p)x + 1 is 1 + y for the real root y of
+    # y**3 + p*y + p, whose float64 np.roots stay accurate near the triple root 1 of small p
+    const_facts = np.logspace(-8, 8, 2001)
+    with tf.Graph().as_default():
+        const_fact = tf.placeholder(tf.float64, shape=[None])
+        with tf.Session() as sess:
+            roots = sess.run(get_cubic_root(const_fact), {const_fact: const_facts})
+    expected = []
+    for p in const_facts:
+        y = np.roots([1., 0., p, p])
+        expected.append(y[np.argmin(np.abs(y.imag))].real + 1)
+    assert np.max(np.abs(roots - np.array(expected))) < 1e-5
+
+
+@pytest.mark.parametrize("num_rows, grad_avg_buckets, rtol", [(50, 4096, 1e-3), (2000, 512, 0.25)])
+def test_sparse_grad_average_matches_dense(num_rows, grad_avg_buckets, rtol):
+    # the estimate for an embedding against the dense moving average of the fetched gradients, at every
+    # step: exact with a bucket per row (a write racing ahead of a read shows), close with fewer buckets
+    from yellowfin import YFOptimizer
+
+    beta = 0.9
+    rng = np.random.RandomState(0)
+    with tf.Graph().as_default():
+        ids = tf.placeholder(tf.int32, shape=[None])
+        embedding = tf.Variable(rng.randn(num_rows, 4).astype(np.float32))
+        target = tf.constant(rng.randn(32, 4).astype(np.float32))
+        loss = tf.reduce_sum(tf.square(tf.gather(embedding, ids) - target))
+        grads = tf.gradients(loss, [embedding])
+        assert isinstance(grads[0], tf.IndexedSlices)
+        optimizer = YFOptimizer(learning_rate=0.01, beta=beta, grad_avg_buckets=grad_avg_buckets)
+        train_op = optimizer.apply_gradients(zip(grads, [embedding]))
+        dense_grad = tf.convert_to_tensor(grads[0])
+        sparse_squared_sum = optimizer._sparse_grad_avg_squared_sums[0]
+
+        grad_avg = np.zeros([num_rows, 4])
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            for step in range(300):
+                # rows repeat within a step and go untouched for several steps
+                _, grad, squared_sum = sess.run([train_op, dense_grad, sparse_squared_sum],
+                                                feed_dict={ids: rng.randint(0, num_rows, 32)})
+                grad_avg = beta * grad_avg + (1 - beta) * grad
+                expected = np.sum(grad_avg ** 2) / (1 - beta ** (step + 1)) ** 2
+                assert np.isclose(squared_sum, expected, rtol=rtol), (step, squared_sum, expected)
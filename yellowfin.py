@@ -14,9 +14,26 @@ GATE_OP = 1
 GATE_GRAPH = 2
 
 
+def get_cubic_root(const_fact):
+    '''
+    The root in (0, 1) of -x**3 + 3x**2 - (3 + p)x + 1 for p = const_fact > 0, solved in-graph.
+    With y = x - 1 the cubic becomes y**3 + p*y + p, which has a single real root for p > 0,
+    given in closed form by Vieta's substitution y = w - p / (3w), w**3 = (-p - sqrt(p**2 + 4p**3 / 27)) / 2.
+    Computed in float64, since w and p / (3w) nearly cancel for large p, and clipped to [0, 1].
+    '''
+    # p -> 0 has the root 1, but w would be 0
+    p = tf.maximum(tf.cast(const_fact, tf.float64), 1e-12)
+    w3 = (-tf.sqrt(p ** 2 + 4.0 / 27.0 * p ** 3) - p) / 2.0
+    # w3 < 0, its real cube root
+    w = -tf.pow(-w3, 1.0 / 3.0)
+    y = w - p / 3.0 / w
+    return tf.cast(tf.clip_by_value(y + 1.0, 0.0, 1.0), const_fact.dtype)
+
+
 class YFOptimizer(object):
     def __init__(self, learning_rate=0.1, momentum=0.0, clip_thresh=None, beta=0.999, curv_win_width=20,
-                 mu_update_interval=1, zero_debias=True, delta_mu=0.0, sparsity_debias=True):
+                 mu_update_interval=1, zero_debias=True, delta_mu=0.0, sparsity_debias=True,
+                 grad_avg_buckets=4096):
         '''
         clip thresh is the threshold value on ||lr * gradient||
         delta_mu can be place holder/variable/python scalar. They are used for additional
@@ -28,11 +45,15 @@ class YFOptimizer(object):
           clip_thresh: python scalar. The cliping threshold for tf.clip_by_global_norm.
             if None, no clipping will be carried out.
           beta: python scalar. The smoothing parameter for estimations.
+          mu_update_interval: python int. lr and mu are tuned every this many steps and stay
+            fixed in between; the statistics are still gathered every step.
           delta_mu: for extensions. Not necessary in the basic use.
           sparsity_debias: gradient norm and curvature are biased to larger values when
           calculated with sparse gradient. This is useful when the model is very sparse,
           e.g. LSTM with word embedding. For non-sparse CNN, turning it off could slightly
           accelerate the speed.
+          grad_avg_buckets: python int. The rows of the sketch that estimates the gradient variance
+            of a sparse gradient (word embedding), see sparse_grad_avg_squared.
         Other features:
           If you want to manually control the learning rates, self.lr_factor is
           an interface to the outside, it is an multiplier for the internal learning rate
@@ -64,11 +85,14 @@ class YFOptimizer(object):
         # for global step counting
         self._global_step = tf.Variable(0, trainable=False)
 
-        # for conditional tuning
-        self._do_tune = tf.greater(self._global_step, tf.constant(0))
+        # for conditional tuning: lr and mu are tuned every mu_update_interval steps and stay fixed in between
+        self._mu_update_interval = mu_update_interval
+        self._do_tune = tf.logical_and(tf.greater(self._global_step, tf.constant(0)),
+                                       tf.equal(self._global_step % mu_update_interval, 0))
 
         self._zero_debias = zero_debias
         self._sparsity_debias = sparsity_debias
+        self._grad_avg_buckets = grad_avg_buckets
 
         self._tvars = None
 
@@ -104,26 +128,71 @@ class YFOptimizer(object):
         return curv_range_ops
 
     def grad_variance(self):
+        # only the moving averages are updated every step, get_grad_var_tensor reduces them on tuning steps
         grad_var_ops = []
         tensor_to_avg = []
-        for t, g in zip(self._tvars, self._grads):
+        self._grad_avg = []
+        self._sparse_grad_avg_squared_sums = []
+        for t, g in zip(self._tvars, self._stat_grads):
             if isinstance(g, ops.IndexedSlices):
-                tensor_to_avg.append(
-                    tf.reshape(tf.unsorted_segment_sum(g.values, g.indices, g.dense_shape[0]), shape=t.get_shape()))
+                with ops.colocate_with(t):
+                    sparse_avg_op, grad_avg_squared_sum = self.sparse_grad_avg_squared(t, g)
+                grad_var_ops.append(sparse_avg_op)
+                self._sparse_grad_avg_squared_sums.append(grad_avg_squared_sum)
             else:
                 tensor_to_avg.append(g)
-        avg_op = self._moving_averager.apply(tensor_to_avg)
-        grad_var_ops.append(avg_op)
-        with tf.control_dependencies([avg_op]):
+        if tensor_to_avg:
+            avg_op = self._moving_averager.apply(tensor_to_avg)
+            grad_var_ops.append(avg_op)
             self._grad_avg = [self._moving_averager.average(val) for val in tensor_to_avg]
-            self._grad_avg_squared = [tf.square(val) for val in self._grad_avg]
-        self._grad_var = tf.maximum(tf.constant(1e-6, dtype=self._grad_norm_squared_avg.dtype),
-                                    self._grad_norm_squared_avg \
-                                    - tf.add_n([tf.reduce_sum(val) for val in self._grad_avg_squared]))
-        if self._sparsity_debias:
-            self._grad_var *= self._sparsity_avg
         return grad_var_ops
 
+    def get_grad_var_tensor(self):
+        grad_avg_squared_sums = self._sparse_grad_avg_squared_sums \
+                                + [tf.reduce_sum(tf.square(val)) for val in self._grad_avg]
+        grad_var = tf.maximum(tf.constant(1e-6, dtype=self._grad_norm_squared_avg.dtype),
+                              self._grad_norm_squared_avg - tf.add_n(grad_avg_squared_sums))
+        if self._sparsity_debias:
+            grad_var *= self._sparsity_avg
+        return grad_var
+
+    def sparse_grad_avg_squared(self, t, g):
+        '''
+        The squared norm of the moving average of a sparse gradient g of variable t, estimated
+        from a count sketch of the average: row i of g is added, multiplied by a random sign
+        s(i), to bucket h(i) of grad_avg_buckets rows. The sketch is linear, so it is the moving
+        average of the sketched gradients, and its squared norm is an unbiased estimate of the
+        squared norm of the average (the colliding rows' cross terms cancel out in expectation).
+        It takes grad_avg_buckets rows instead of a shadow of t; with no more rows than buckets,
+        each row gets its own and the estimate equals the ExponentialMovingAverage of the dense gradient.
+        Returns the update op and the (debiased) squared norm after it.
+        '''
+        name = t.op.name.replace("/", "_")
+        num_rows = t.get_shape()[0].value
+        num_buckets = min(num_rows, self._grad_avg_buckets)
+        sketch = tf.Variable(tf.zeros([num_buckets] + t.get_shape()[1:].as_list(), dtype=t.dtype),
+                             name=name + "_grad_avg_sketch", trainable=False)
+
+        if num_buckets == num_rows:
+            buckets, values = g.indices, g.values
+        else:
+            # universal hashes modulo the prime 2 ** 31 - 1, no table of the vocabulary
+            indices = tf.cast(g.indices, tf.int64)
+            buckets = (indices * 1103515245 + 12345) % 2147483647 % num_buckets
+            signs = tf.cast(1 - 2 * ((indices * 2654435761 + 97) % 2147483647 % 2), t.dtype)
+            values = g.values * tf.reshape(signs, [-1] + [1] * (g.values.get_shape().ndims - 1))
+        beta = tf.constant(self._beta, dtype=t.dtype)
+        new_sketch = beta * sketch + (1 - beta) * tf.unsorted_segment_sum(values, buckets, num_buckets)
+        squared_sum = tf.reduce_sum(tf.square(new_sketch))
+        if self._zero_debias:
+            num_updates = tf.cast(self._global_step + 1, t.dtype)
+            squared_sum /= (1 - beta ** num_updates) ** 2
+        # the debiasing reads the global step before this step increments it
+        with tf.control_dependencies([squared_sum]):
+            avg_op = tf.assign(sketch, new_sketch)
+        with tf.control_dependencies([avg_op]):
+            return avg_op, tf.identity(squared_sum)
+
     def dist_to_opt(self):
         dist_to_opt_ops = []
         # running average of the norm of gradeint
@@ -148,8 +217,12 @@ class YFOptimizer(object):
         # its sparsity is 0.1, the norm of dense gradient averaged from full dataset
         # are roughly estimated norm of minibatch sparse gradient norm * sqrt(sparsity).
         # An extension maybe only correct the sparse blob.
-        non_zero_cnt = tf.add_n([tf.count_nonzero(g) for g in self._grads])
-        all_entry_cnt = tf.add_n([tf.size(g) for g in self._grads])
+        # sparse gradients count their touched rows, the others are zero
+        non_zero_cnt = tf.add_n([tf.count_nonzero(g.values if isinstance(g, ops.IndexedSlices) else g)
+                                 for g in self._stat_grads])
+        all_entry_cnt = tf.add_n([tf.reduce_prod(tf.cast(g.dense_shape, tf.int64))
+                                  if isinstance(g, ops.IndexedSlices) else tf.size(g, out_type=tf.int64)
+                                  for g in self._stat_grads])
         self._sparsity = tf.cast(non_zero_cnt, self._grads[0].dtype) \
                          / tf.cast(all_entry_cnt, self._grads[0].dtype)
         avg_op = self._moving_averager.apply([self._sparsity, ])
@@ -163,12 +236,21 @@ class YFOptimizer(object):
         after_apply_ops = []
 
         # get per var g**2 and norm**2
+        self._stat_grads = []
         self._grad_squared = []
         self._grad_norm_squared = []
         for v, g in zip(self._tvars, self._grads):
             if g is None: continue
             with ops.colocate_with(v):
-                self._grad_squared.append(tf.square(g))
+                if isinstance(g, ops.IndexedSlices):
+                    # sum up repeated rows, the values are then the touched rows of the dense gradient
+                    indices, positions = tf.unique(g.indices)
+                    g = ops.IndexedSlices(tf.unsorted_segment_sum(g.values, positions, tf.size(indices)),
+                                          indices, g.dense_shape)
+                    self._grad_squared.append(tf.square(g.values))
+                else:
+                    self._grad_squared.append(tf.square(g))
+            self._stat_grads.append(g)
         self._grad_norm_squared = [tf.reduce_sum(grad_squared) for grad_squared in self._grad_squared]
 
         if self._sparsity_debias:
@@ -199,36 +281,28 @@ class YFOptimizer(object):
 
     def get_mu_tensor(self):
         const_fact = self._dist_to_opt_avg ** 2 * self._h_min ** 2 / 2 / self._grad_var
-        coef = tf.Variable([-1.0, 3.0, 0.0, 1.0], dtype=tf.float32, name="cubic_solver_coef")
-        coef = tf.scatter_update(coef, tf.constant(2), -(3 + const_fact))
-        roots = tf.py_func(np.roots, [coef], Tout=tf.complex64, stateful=False)
-
-        # filter out the correct root
-        root_idx = tf.logical_and(tf.logical_and(tf.greater(tf.real(roots), tf.constant(0.0)),
-                                                 tf.less(tf.real(roots), tf.constant(1.0))),
-                                  tf.less(tf.abs(tf.imag(roots)), 1e-5))
-        # in case there are two duplicated roots satisfying the above condition
-        root = tf.reshape(tf.gather(tf.gather(roots, tf.where(root_idx)), tf.constant(0)), shape=[])
-
+        root = get_cubic_root(const_fact)
         dr = self._h_max / self._h_min
-        with tf.control_dependencies([tf.assert_equal(tf.size(root), tf.constant(1)), ]):
-            mu = tf.maximum(tf.real(root) ** 2, ((tf.sqrt(dr) - 1) / (tf.sqrt(dr) + 1)) ** 2)
+        mu = tf.maximum(root ** 2, ((tf.sqrt(dr) - 1) / (tf.sqrt(dr) + 1)) ** 2)
         return mu
 
     def update_hyper_param(self):
-        assign_hyper_ops = []
-        self._mu = tf.identity(tf.cond(self._do_tune, lambda: self.get_mu_tensor(),
-                                       lambda: self._mu_var))
-        with tf.control_dependencies([self._mu]):
-            self._lr = tf.identity(tf.cond(self._do_tune, lambda: self.get_lr_tensor(),
-                                           lambda: self._lr_var))
-
-        with tf.control_dependencies([self._mu, self._lr]):
-            self._mu = self._beta * self._mu_var + (1 - self._beta) * self._mu
-            self._lr = self._beta * self._lr_var + (1 - self._beta) * self._lr
-            assign_hyper_ops.append(tf.assign(self._mu_var, self._mu))
-            assign_hyper_ops.append(tf.assign(self._lr_var, self._lr))
-        assign_hyper_op = tf.group(*assign_hyper_ops)
+        def tune():
+            # the variance reductions and the cubic solve only run on tuning steps
+            self._grad_var = self.get_grad_var_tensor()
+            self._mu = self.get_mu_tensor()
+            with tf.control_dependencies([self._mu]):
+                self._lr = self.get_lr_tensor()
+            # the smoothing of the mu_update_interval steps since the last tuning at once
+            beta = self._beta ** self._mu_update_interval
+            mu = tf.assign(self._mu_var, beta * self._mu_var + (1 - beta) * self._mu)
+            lr = tf.assign(self._lr_var, beta * self._lr_var + (1 - beta) * self._lr)
+            return tf.identity(mu), tf.identity(lr)
+
+        def keep():
+            return tf.identity(self._mu_var), tf.identity(self._lr_var)
+
+        assign_hyper_op = tf.group(*tf.cond(self._do_tune, tune, keep))
         return assign_hyper_op
 
     def apply_gradients(self, grads_tvars, global_step=None):
@@ -296,4 +370,4 @@ class YFOptimizer(object):
             print("g ", g)
             print("v ", v)
 
-        return self.apply_gradients(grads_and_vars)
\ No newline at end of file
+        return self.apply_gradients(grads_and_vars)